@@ -10,20 +10,20 @@
 """
 import os
 from datetime import datetime
-from zoneinfo import ZoneInfo
-from astral.sun import sun
-from astral.location import LocationInfo
 
-from qgis.core import (
-    QgsPointXY, QgsFeature, QgsGeometry, QgsField,
-    QgsProject, QgsWkbTypes, QgsCoordinateTransform)
+from qgis.core import QgsProject, QgsCoordinateTransform
 
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingException,
+    QgsProcessingOutputVectorLayer,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterDateTime,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterField,
+    QgsProcessingParameterNumber,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterFeatureSink)
 
@@ -31,6 +31,12 @@ from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtCore import QVariant, QUrl
 
 from .settings import epsg4326, tzf_instance
+from .pipeline import CHUNK_SIZE, RANGE_CELLS, OUTPUT_MODES, OutputFeatureBuilder, InPlaceUpdater, CoordinateDeduplicator, BufferedSink, coordinateShards, epochValues
+from .parallel import ShardExecutor, snapErrorShard, sunShard, sunRangeShard, sunEpochShard
+from .solar import EVENT_SETS, ENGINES, FMT_ISO_UTC, FMT_ISO_LOCAL, FMT_DEFAULT
+
+TIME_FIELD_TYPES = ['Formatted text', 'Date/time', 'Epoch seconds (UTC)']
+TIME_FIELD_QVARIANTS = [QVariant.String, QVariant.DateTime, QVariant.LongLong]
 
 class AddAstronomicalAlgorithm(QgsProcessingAlgorithm):
     """
@@ -41,7 +47,18 @@ class AddAstronomicalAlgorithm(QgsProcessingAlgorithm):
     PrmUseUTC = 'UseUTC'
     PrmOutputLayer = 'OutputLayer'
     PrmDate = 'Date'
+    PrmEndDate = 'EndDate'
     PrmUseISO = 'UseISO'
+    PrmEngine = 'Engine'
+    PrmEventSets = 'EventSets'
+    PrmTimeFieldType = 'TimeFieldType'
+    PrmOutputMode = 'OutputMode'
+    PrmKeyField = 'KeyField'
+    PrmDedupTolerance = 'DedupTolerance'
+    PrmCacheSize = 'CacheSize'
+    PrmWorkers = 'Workers'
+    PrmBatchSize = 'BatchSize'
+    in_place = False
 
     def initAlgorithm(self, config):
         self.addParameter(
@@ -72,86 +89,224 @@ class AddAstronomicalAlgorithm(QgsProcessingAlgorithm):
                 optional=False,
                 )
         )
+        if not self.in_place:
+            self.addParameter(
+                QgsProcessingParameterDateTime(
+                    self.PrmEndDate,
+                    'End date for a daily series (one output row per feature and date)',
+                    type=QgsProcessingParameterDateTime.Date,
+                    optional=True,
+                    )
+            )
         self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.PrmOutputLayer,
-                'Output layer')
+            QgsProcessingParameterEnum(
+                self.PrmEventSets,
+                'Sun events to add',
+                options=[label for label, events in EVENT_SETS],
+                allowMultiple=True,
+                defaultValue=[0],
+                optional=False)
         )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PrmTimeFieldType,
+                'Sun time field type (the ISO8601 option only applies to formatted text)',
+                options=TIME_FIELD_TYPES,
+                defaultValue=0,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PrmEngine,
+                'Solar computation engine',
+                options=ENGINES,
+                defaultValue=0,
+                optional=True)
+        )
+        if not self.in_place:
+            self.addParameter(
+                QgsProcessingParameterEnum(
+                    self.PrmOutputMode,
+                    'Output mode',
+                    options=OUTPUT_MODES,
+                    defaultValue=0,
+                    optional=True)
+            )
+            self.addParameter(
+                QgsProcessingParameterField(
+                    self.PrmKeyField,
+                    'Key field for the attribute table output (default is the source feature id)',
+                    parentLayerParameterName=self.PrmInputLayer,
+                    type=QgsProcessingParameterField.Any,
+                    optional=True)
+            )
+        param = QgsProcessingParameterNumber(
+            self.PrmDedupTolerance,
+            'Tolerance in degrees for grouping identical locations (0 groups exact coordinates)',
+            QgsProcessingParameterNumber.Double,
+            defaultValue=0,
+            minValue=0,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmCacheSize,
+            'Number of locations kept in the cache (location-days for a daily series)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=1000000,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmWorkers,
+            'Number of worker processes (1 runs in the QGIS process)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmBatchSize,
+            'Number of features written to the output layer at a time',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=CHUNK_SIZE,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        if self.in_place:
+            self.addOutput(QgsProcessingOutputVectorLayer(self.PrmOutputLayer, 'Updated layer'))
+        else:
+            self.addParameter(
+                QgsProcessingParameterFeatureSink(
+                    self.PrmOutputLayer,
+                    'Output layer')
+            )
 
     def processAlgorithm(self, parameters, context, feedback):
-        source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
         use_utc = self.parameterAsBool(parameters, self.PrmUseUTC, context)
         use_iso = self.parameterAsBool(parameters, self.PrmUseISO, context)
+        engine = self.parameterAsInt(parameters, self.PrmEngine, context)
+        event_sets = self.parameterAsEnums(parameters, self.PrmEventSets, context)
+        time_field_type = TIME_FIELD_QVARIANTS[self.parameterAsInt(parameters, self.PrmTimeFieldType, context)]
         dt = self.parameterAsDateTime(parameters, self.PrmDate, context)
+        tolerance = self.parameterAsDouble(parameters, self.PrmDedupTolerance, context)
+        cache_size = self.parameterAsInt(parameters, self.PrmCacheSize, context)
+        workers = self.parameterAsInt(parameters, self.PrmWorkers, context)
+        batch_size = self.parameterAsInt(parameters, self.PrmBatchSize, context)
+        attributes_only = self.parameterAsInt(parameters, self.PrmOutputMode, context) == 1
+        key_field = self.parameterAsString(parameters, self.PrmKeyField, context)
         qdate = dt.date()
         if not qdate.isValid():
             raise QgsProcessingException('Use a proper date and rerun algorithm')
         date = datetime(qdate.year(), qdate.month(), qdate.day())
+        end_dt = self.parameterAsDateTime(parameters, self.PrmEndDate, context)
+        days = qdate.daysTo(end_dt.date()) + 1 if end_dt.isValid() else 0
+        if end_dt.isValid() and days < 1:
+            raise QgsProcessingException('The end date must not be before the start date')
         
-        fields = source.fields()
-        src_crs = source.sourceCrs()
-        if fields.append(QgsField("dawn", QVariant.String)) is False:
-            raise QgsProcessingException("Field names must be unique. There is already a field named 'dawn'")
-        if fields.append(QgsField("sunrise", QVariant.String)) is False:
-            raise QgsProcessingException("Field names must be unique. There is already a field named 'sunrise'")
-        if fields.append(QgsField("noon", QVariant.String)) is False:
-            raise QgsProcessingException("Field names must be unique. There is already a field named 'noon'")
-        if fields.append(QgsField("sunset", QVariant.String)) is False:
-            raise QgsProcessingException("Field names must be unique. There is already a field named 'sunset'")
-        if fields.append(QgsField("dusk", QVariant.String)) is False:
-            raise QgsProcessingException("Field names must be unique. There is already a field named 'dusk'")
-
-        (sink, dest_id) = self.parameterAsSink(
-            parameters, self.PrmOutputLayer, context, fields,
-            source.wkbType(), src_crs)
+        if not event_sets:
+            raise QgsProcessingException('Select at least one set of sun events')
+        # All the selected events are computed together
+        events = [event for i in sorted(event_sets) for event in EVENT_SETS[i][1]]
+        new_fields = [(name, time_field_type) for name in events]
+        if days:
+            new_fields.insert(0, ('date', QVariant.Date))
+
+        if self.in_place:
+            layer = self.parameterAsVectorLayer(parameters, self.PrmInputLayer, context)
+            if layer is None:
+                raise QgsProcessingException('Updating in place requires the input to be a vector layer')
+            output = InPlaceUpdater(layer, new_fields, batch_size)
+            # The source is created after the new fields are added so that it
+            # has them, and it keeps the selection and filter of the input
+            source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
+            src_crs = source.sourceCrs()
+            iterator = source.getFeatures(output.request())
+            dest_id = layer.id()
+        else:
+            source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
+            src_crs = source.sourceCrs()
+            builder = OutputFeatureBuilder(source, attributes_only, key_field)
+            for name, field_type in new_fields:
+                builder.addField(name, field_type)
+            (sink, dest_id) = self.parameterAsSink(
+                parameters, self.PrmOutputLayer, context, builder.fields,
+                builder.wkb_type, src_crs)
+            output = BufferedSink(sink, batch_size)
+            iterator = source.getFeatures()
 
         if src_crs != epsg4326:
             transform = QgsCoordinateTransform(src_crs, epsg4326, QgsProject.instance())
+        else:
+            transform = None
         if use_iso:
             if use_utc:
-                fmt = '%Y-%m-%dT%H:%M:%SZ'
+                fmt = FMT_ISO_UTC
             else:
-                fmt = '%Y-%m-%dT%H:%M:%S%z'
+                fmt = FMT_ISO_LOCAL
         else:
-            fmt = '%Y-%m-%d %H:%M:%S %Z%z'
-        tzf = tzf_instance.getTZF()
+            fmt = FMT_DEFAULT
+        tz_index = None if use_utc else tzf_instance.getTZIndex(feedback)
+        executor = ShardExecutor(workers, tz_index)
         total = 100.0 / source.featureCount() if source.featureCount() else 0
 
-        iterator = source.getFeatures()
-        for cnt, feature in enumerate(iterator):
-            if feedback.isCanceled():
-                break
-            f = QgsFeature()
-            f.setGeometry(feature.geometry())
-            pt = feature.geometry().asPoint()
-            if src_crs != epsg4326:
-                pt = transform.transform(pt)
-            
-            try:
-                locl = LocationInfo('','','',pt.y(), pt.x())
-                if use_utc:
-                    s = sun(locl.observer, date=date)
-                else:
-                    tz_name = tzf.timezone_at(lng=pt.x(), lat=pt.y())
-                    tz = ZoneInfo(tz_name)
-                    loc_dt = date.replace(tzinfo=tz)
-                    s = sun(locl.observer, date=date, tzinfo=tz)
-                dawn = s["dawn"].strftime(fmt)
-                sunrise = s["sunrise"].strftime(fmt)
-                noon = s["noon"].strftime(fmt)
-                sunset = s["sunset"].strftime(fmt)
-                dusk = s["dusk"].strftime(fmt)
-            except Exception:
-                dawn = ""
-                sunrise = ""
-                noon = ""
-                sunset = ""
-                dusk = ""
-            f.setAttributes(feature.attributes() + [dawn, sunrise, noon, sunset, dusk])
-            sink.addFeature(f)
-
-            if cnt % 100 == 0:
+        cnt = 0
+        # A daily series caches the values of all its days for each location
+        dedup = CoordinateDeduplicator(tolerance, cache_size // days if days else cache_size,
+            None if tz_index is None else tz_index.sameZone)
+        typed = time_field_type != QVariant.String
+        blank = [None if typed else ''] * len(events)
+        if typed:
+            # Epochs are converted straight to field values without formatting
+            shard_func, args = sunEpochShard, (max(1, days), use_utc, engine, events)
+        elif days:
+            shard_func, args = sunRangeShard, (days, use_utc, fmt, engine, events)
+        else:
+            shard_func, args = sunShard, (use_utc, fmt, engine, events)
+        if tolerance > 0:
+            shard_func, args = snapErrorShard, (tolerance, max(1, days), events, shard_func) + args
+        # Each shard computes its features x days in one pass so its size is bounded by RANGE_CELLS
+        chunk_size = max(1, RANGE_CELLS // days) if days else CHUNK_SIZE
+        shards = coordinateShards(iterator, transform, dedup, date, *args, chunk_size=chunk_size)
+        if days:
+            blank = [blank] * days
+            qdates = [qdate.addDays(d) for d in range(days)]
+        try:
+            for (chunk, state), results in executor.imap(shard_func, shards, feedback):
+                if tolerance > 0:
+                    results, errors = results
+                    dedup.addErrors(errors)
+                if typed:
+                    epochs, offsets = results
+                    results = epochValues(epochs, None if use_utc else offsets, time_field_type)
+                    if not days:
+                        results = [point_days[0] for point_days in results]
+                sun_times = dedup.expand(state, results, blank)
+                for feature, times in zip(chunk, sun_times):
+                    if days:
+                        for qd, day_times in zip(qdates, times):
+                            output.addFeature(builder.feature(feature, [qd] + day_times))
+                    elif self.in_place:
+                        output.updateFeature(feature, times)
+                    else:
+                        output.addFeature(builder.feature(feature, times))
+
+                cnt += len(chunk)
                 feedback.setProgress(int(cnt * total))
+        except Exception:
+            if self.in_place:
+                output.rollBack()
+            raise
+        finally:
+            executor.shutdown()
+        if self.in_place:
+            output.commit()
+        else:
+            output.flush()
+        feedback.pushInfo(dedup.summary())
 
         return {self.PrmOutputLayer: dest_id}
 
@@ -172,3 +327,23 @@ class AddAstronomicalAlgorithm(QgsProcessingAlgorithm):
 
     def createInstance(self):
         return AddAstronomicalAlgorithm()
+
+class FillAstronomicalInPlaceAlgorithm(AddAstronomicalAlgorithm):
+    """
+    Algorithm to fill in the empty sun attributes of the input layer.
+    """
+
+    in_place = True
+
+    def flags(self):
+        # The project layer is edited, which is only safe in the main thread
+        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading
+
+    def name(self):
+        return 'fillsunattributes'
+
+    def displayName(self):
+        return 'Fill in sun attributes in place'
+
+    def createInstance(self):
+        return FillAstronomicalInPlaceAlgorithm()
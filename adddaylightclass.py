@@ -0,0 +1,43 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import numpy as np
+
+from qgis.PyQt.QtCore import QVariant
+
+from .addsunposition import AddSunPositionAlgorithm
+from .parallel import daylightShard
+from .solar import DAYLIGHT_CLASSES
+
+class AddDaylightClassAlgorithm(AddSunPositionAlgorithm):
+    """
+    Algorithm to label each feature as day, civil, nautical or astronomical
+    twilight, or night at its own date and time.
+    """
+
+    def newFields(self):
+        return [('daylight', QVariant.String)]
+
+    def shardFunction(self):
+        return daylightShard
+
+    def chunkValues(self, results):
+        # Invalid points (-1) get the last label which is NULL
+        labels = np.array(DAYLIGHT_CLASSES + [None], dtype=object)[results]
+        return [[label] for label in labels.tolist()], int((results < 0).sum())
+
+    def name(self):
+        return 'adddaylightclass'
+
+    def displayName(self):
+        return 'Add day/night classification'
+
+    def createInstance(self):
+        return AddDaylightClassAlgorithm()
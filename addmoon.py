@@ -0,0 +1,219 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from datetime import datetime
+
+from qgis.core import QgsProject, QgsCoordinateTransform
+
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterDateTime,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterField,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFeatureSink)
+
+from qgis.PyQt.QtGui import QIcon
+from qgis.PyQt.QtCore import QVariant, QUrl
+
+from .settings import epsg4326, tzf_instance
+from .pipeline import CHUNK_SIZE, OUTPUT_MODES, OutputFeatureBuilder, CoordinateDeduplicator, BufferedSink, coordinateShards
+from .parallel import ShardExecutor, moonShard
+from .lunar import MOON_ENGINES, MOON_EVENTS, moonIllumination, moonPhase
+from .solar import FMT_ISO_UTC, FMT_ISO_LOCAL, FMT_DEFAULT
+
+class AddMoonAttributesAlgorithm(QgsProcessingAlgorithm):
+    """
+    Algorithm to add the moonrise, moonset, moon phase and illumination of a date.
+    """
+
+    PrmInputLayer = 'InputLayer'
+    PrmUseUTC = 'UseUTC'
+    PrmUseISO = 'UseISO'
+    PrmDate = 'Date'
+    PrmEngine = 'Engine'
+    PrmOutputMode = 'OutputMode'
+    PrmKeyField = 'KeyField'
+    PrmCacheSize = 'CacheSize'
+    PrmWorkers = 'Workers'
+    PrmBatchSize = 'BatchSize'
+    PrmOutputLayer = 'OutputLayer'
+
+    def initAlgorithm(self, config):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.PrmInputLayer,
+                'Input point layer',
+                [QgsProcessing.TypeVectorPoint])
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PrmUseUTC,
+                'Use UTC for date and time',
+                True,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PrmUseISO,
+                'Use ISO8601 timestamps',
+                False,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterDateTime(
+                self.PrmDate,
+                'Select date for lunar calculations',
+                type=QgsProcessingParameterDateTime.Date,
+                optional=False,
+                )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PrmEngine,
+                'Lunar computation engine',
+                options=MOON_ENGINES,
+                defaultValue=0,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PrmOutputMode,
+                'Output mode',
+                options=OUTPUT_MODES,
+                defaultValue=0,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.PrmKeyField,
+                'Key field for the attribute table output (default is the source feature id)',
+                parentLayerParameterName=self.PrmInputLayer,
+                type=QgsProcessingParameterField.Any,
+                optional=True)
+        )
+        param = QgsProcessingParameterNumber(
+            self.PrmCacheSize,
+            'Number of locations kept in the cache',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=1000000,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmWorkers,
+            'Number of worker processes (1 runs in the QGIS process)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmBatchSize,
+            'Number of features written to the output layer at a time',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=CHUNK_SIZE,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.PrmOutputLayer,
+                'Output layer')
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
+        use_utc = self.parameterAsBool(parameters, self.PrmUseUTC, context)
+        use_iso = self.parameterAsBool(parameters, self.PrmUseISO, context)
+        engine = self.parameterAsInt(parameters, self.PrmEngine, context)
+        dt = self.parameterAsDateTime(parameters, self.PrmDate, context)
+        cache_size = self.parameterAsInt(parameters, self.PrmCacheSize, context)
+        workers = self.parameterAsInt(parameters, self.PrmWorkers, context)
+        batch_size = self.parameterAsInt(parameters, self.PrmBatchSize, context)
+        attributes_only = self.parameterAsInt(parameters, self.PrmOutputMode, context) == 1
+        key_field = self.parameterAsString(parameters, self.PrmKeyField, context)
+        qdate = dt.date()
+        if not qdate.isValid():
+            raise QgsProcessingException('Use a proper date and rerun algorithm')
+        date = datetime(qdate.year(), qdate.month(), qdate.day())
+
+        builder = OutputFeatureBuilder(source, attributes_only, key_field)
+        for name in MOON_EVENTS:
+            builder.addField(name, QVariant.String)
+        builder.addField('moon_phase', QVariant.Double)
+        builder.addField('moon_illum', QVariant.Double)
+        src_crs = source.sourceCrs()
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, self.PrmOutputLayer, context, builder.fields,
+            builder.wkb_type, src_crs)
+        output = BufferedSink(sink, batch_size)
+
+        if src_crs != epsg4326:
+            transform = QgsCoordinateTransform(src_crs, epsg4326, QgsProject.instance())
+        else:
+            transform = None
+        if use_iso:
+            if use_utc:
+                fmt = FMT_ISO_UTC
+            else:
+                fmt = FMT_ISO_LOCAL
+        else:
+            fmt = FMT_DEFAULT
+        # The phase and illumination are the same for every feature of the date
+        shared = [round(moonPhase(date), 4), round(moonIllumination(date), 4)]
+        tz_index = None if use_utc else tzf_instance.getTZIndex(feedback)
+        executor = ShardExecutor(workers, tz_index)
+        total = 100.0 / source.featureCount() if source.featureCount() else 0
+
+        cnt = 0
+        dedup = CoordinateDeduplicator(0.0, cache_size)
+        shards = coordinateShards(source.getFeatures(), transform, dedup, date, use_utc, fmt, engine)
+        try:
+            for (chunk, state), results in executor.imap(moonShard, shards, feedback):
+                moon_times = dedup.expand(state, results, [''] * len(MOON_EVENTS))
+                for feature, times in zip(chunk, moon_times):
+                    output.addFeature(builder.feature(feature, times + shared))
+
+                cnt += len(chunk)
+                feedback.setProgress(int(cnt * total))
+        finally:
+            executor.shutdown()
+        output.flush()
+        feedback.pushInfo(dedup.summary())
+
+        return {self.PrmOutputLayer: dest_id}
+
+    def name(self):
+        return 'addmoonattributes'
+
+    def displayName(self):
+        return 'Add moon attributes'
+
+    def icon(self):
+        return QIcon(os.path.dirname(__file__) + '/images/sun.svg')
+
+    def helpUrl(self):
+        file = os.path.dirname(__file__) + '/index.html'
+        if not os.path.exists(file):
+            return ''
+        return QUrl.fromLocalFile(file).toString(QUrl.FullyEncoded)
+
+    def createInstance(self):
+        return AddMoonAttributesAlgorithm()
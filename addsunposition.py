@@ -0,0 +1,188 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import numpy as np
+
+from qgis.core import QgsProject, QgsCoordinateTransform
+
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterField,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFeatureSink)
+
+from qgis.PyQt.QtGui import QIcon
+from qgis.PyQt.QtCore import QVariant, QUrl
+
+from .settings import epsg4326
+from .pipeline import CHUNK_SIZE, OUTPUT_MODES, OutputFeatureBuilder, BufferedSink, timestampShards
+from .parallel import ShardExecutor, sunPositionShard
+
+class AddSunPositionAlgorithm(QgsProcessingAlgorithm):
+    """
+    Algorithm to add the sun azimuth and elevation at the date and time of each feature.
+    """
+
+    PrmInputLayer = 'InputLayer'
+    PrmDateTimeField = 'DateTimeField'
+    PrmNaiveUTC = 'NaiveUTC'
+    PrmOutputMode = 'OutputMode'
+    PrmKeyField = 'KeyField'
+    PrmWorkers = 'Workers'
+    PrmBatchSize = 'BatchSize'
+    PrmOutputLayer = 'OutputLayer'
+
+    def initAlgorithm(self, config):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.PrmInputLayer,
+                'Input point layer',
+                [QgsProcessing.TypeVectorPoint])
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.PrmDateTimeField,
+                'Date/time field (date/time or ISO 8601 string)',
+                parentLayerParameterName=self.PrmInputLayer,
+                type=QgsProcessingParameterField.Any,
+                optional=False)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PrmNaiveUTC,
+                'Date/times without a time zone are UTC (otherwise the local time of this computer)',
+                True,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PrmOutputMode,
+                'Output mode',
+                options=OUTPUT_MODES,
+                defaultValue=0,
+                optional=True)
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.PrmKeyField,
+                'Key field for the attribute table output (default is the source feature id)',
+                parentLayerParameterName=self.PrmInputLayer,
+                type=QgsProcessingParameterField.Any,
+                optional=True)
+        )
+        param = QgsProcessingParameterNumber(
+            self.PrmWorkers,
+            'Number of worker processes (1 runs in the QGIS process)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmBatchSize,
+            'Number of features written to the output layer at a time',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=CHUNK_SIZE,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.PrmOutputLayer,
+                'Output layer')
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
+        dt_field = self.parameterAsString(parameters, self.PrmDateTimeField, context)
+        naive_utc = self.parameterAsBool(parameters, self.PrmNaiveUTC, context)
+        attributes_only = self.parameterAsInt(parameters, self.PrmOutputMode, context) == 1
+        key_field = self.parameterAsString(parameters, self.PrmKeyField, context)
+        workers = self.parameterAsInt(parameters, self.PrmWorkers, context)
+        batch_size = self.parameterAsInt(parameters, self.PrmBatchSize, context)
+        dt_index = source.fields().indexOf(dt_field)
+
+        builder = OutputFeatureBuilder(source, attributes_only, key_field)
+        for name, field_type in self.newFields():
+            builder.addField(name, field_type)
+        src_crs = source.sourceCrs()
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, self.PrmOutputLayer, context, builder.fields,
+            builder.wkb_type, src_crs)
+        output = BufferedSink(sink, batch_size)
+
+        if src_crs != epsg4326:
+            transform = QgsCoordinateTransform(src_crs, epsg4326, QgsProject.instance())
+        else:
+            transform = None
+        executor = ShardExecutor(workers)
+        total = 100.0 / source.featureCount() if source.featureCount() else 0
+
+        cnt = 0
+        invalid = 0
+        shards = timestampShards(source.getFeatures(), transform, dt_index, naive_utc)
+        try:
+            for chunk, results in executor.imap(self.shardFunction(), shards, feedback):
+                values, missing = self.chunkValues(results)
+                invalid += missing
+                for feature, feature_values in zip(chunk, values):
+                    output.addFeature(builder.feature(feature, feature_values))
+
+                cnt += len(chunk)
+                feedback.setProgress(int(cnt * total))
+        finally:
+            executor.shutdown()
+        output.flush()
+        if invalid:
+            feedback.pushInfo('{} features without a valid date/time or point were left empty'.format(invalid))
+
+        return {self.PrmOutputLayer: dest_id}
+
+    def newFields(self):
+        return [('sun_azimuth', QVariant.Double), ('sun_elevation', QVariant.Double)]
+
+    def shardFunction(self):
+        return sunPositionShard
+
+    def chunkValues(self, results):
+        '''Return the attribute values of each feature of a chunk from the
+        shard results and the number of features that could not be computed.'''
+        azimuths, elevations = results
+        missing = np.isnan(elevations)
+        # NaN is written as NULL
+        azimuths = np.where(missing, None, azimuths).tolist()
+        elevations = np.where(missing, None, elevations).tolist()
+        return list(zip(azimuths, elevations)), int(missing.sum())
+
+    def name(self):
+        return 'addsunposition'
+
+    def displayName(self):
+        return 'Add sun position attributes'
+
+    def icon(self):
+        return QIcon(os.path.dirname(__file__) + '/images/sun.svg')
+
+    def helpUrl(self):
+        file = os.path.dirname(__file__) + '/index.html'
+        if not os.path.exists(file):
+            return ''
+        return QUrl.fromLocalFile(file).toString(QUrl.FullyEncoded)
+
+    def createInstance(self):
+        return AddSunPositionAlgorithm()
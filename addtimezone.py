@@ -14,15 +14,20 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 
 from qgis.core import (
-    QgsPointXY, QgsFeature, QgsGeometry, QgsField,
+    QgsPointXY, QgsFeature, QgsGeometry, QgsField, QgsFields,
     QgsProject, QgsWkbTypes, QgsCoordinateTransform)
 
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingException,
+    QgsProcessingOutputVectorLayer,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterDateTime,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterField,
+    QgsProcessingParameterNumber,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterFeatureSink)
 
@@ -30,6 +35,9 @@ from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtCore import QVariant, QUrl
 
 from .settings import epsg4326, tzf_instance
+from .tzlookup import OffsetCache, ZoneCodes
+from .pipeline import CHUNK_SIZE, OUTPUT_MODES, OutputFeatureBuilder, InPlaceUpdater, CoordinateDeduplicator, BufferedSink, coordinateShards
+from .parallel import ShardExecutor, timezoneShard
 
 class AddTimezoneAlgorithm(QgsProcessingAlgorithm):
     """
@@ -40,6 +48,14 @@ class AddTimezoneAlgorithm(QgsProcessingAlgorithm):
     PrmOutputLayer = 'OutputLayer'
     PrmDate = 'Date'
     PrmAddOffset = 'AddOffset'
+    PrmEncodeTzid = 'EncodeTzid'
+    PrmLookupTable = 'LookupTable'
+    PrmOutputMode = 'OutputMode'
+    PrmKeyField = 'KeyField'
+    PrmDedupTolerance = 'DedupTolerance'
+    PrmWorkers = 'Workers'
+    PrmBatchSize = 'BatchSize'
+    in_place = False
 
     def initAlgorithm(self, config):
         self.addParameter(
@@ -63,71 +79,193 @@ class AddTimezoneAlgorithm(QgsProcessingAlgorithm):
                 optional=True,
                 )
         )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PrmEncodeTzid,
+                'Write an integer time zone code (tz_code) instead of the time zone name',
+                False,
+                optional=True)
+        )
+        if not self.in_place:
+            self.addParameter(
+                QgsProcessingParameterEnum(
+                    self.PrmOutputMode,
+                    'Output mode',
+                    options=OUTPUT_MODES,
+                    defaultValue=0,
+                    optional=True)
+            )
+            self.addParameter(
+                QgsProcessingParameterField(
+                    self.PrmKeyField,
+                    'Key field for the attribute table output (default is the source feature id)',
+                    parentLayerParameterName=self.PrmInputLayer,
+                    type=QgsProcessingParameterField.Any,
+                    optional=True)
+            )
+        param = QgsProcessingParameterNumber(
+            self.PrmDedupTolerance,
+            'Tolerance in degrees for grouping identical locations (0 groups exact coordinates)',
+            QgsProcessingParameterNumber.Double,
+            defaultValue=0,
+            minValue=0,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmWorkers,
+            'Number of worker processes (1 runs in the QGIS process)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmBatchSize,
+            'Number of features written to the output layer at a time',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=CHUNK_SIZE,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        if self.in_place:
+            self.addOutput(QgsProcessingOutputVectorLayer(self.PrmOutputLayer, 'Updated layer'))
+        else:
+            self.addParameter(
+                QgsProcessingParameterFeatureSink(
+                    self.PrmOutputLayer,
+                    'Output layer')
+            )
         self.addParameter(
             QgsProcessingParameterFeatureSink(
-                self.PrmOutputLayer,
-                'Output layer')
+                self.PrmLookupTable,
+                'Time zone code lookup table',
+                type=QgsProcessing.TypeVector,
+                optional=True,
+                createByDefault=False)
         )
 
     def processAlgorithm(self, parameters, context, feedback):
-        source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
         add_offset = self.parameterAsBool(parameters, self.PrmAddOffset, context)
+        encode_tzid = self.parameterAsBool(parameters, self.PrmEncodeTzid, context)
         dt = self.parameterAsDateTime(parameters, self.PrmDate, context)
+        tolerance = self.parameterAsDouble(parameters, self.PrmDedupTolerance, context)
+        workers = self.parameterAsInt(parameters, self.PrmWorkers, context)
+        batch_size = self.parameterAsInt(parameters, self.PrmBatchSize, context)
+        attributes_only = self.parameterAsInt(parameters, self.PrmOutputMode, context) == 1
+        key_field = self.parameterAsString(parameters, self.PrmKeyField, context)
         qdate = dt.date()
         if add_offset and not qdate.isValid():
             raise QgsProcessingException('Use a proper date and rerun algorithm')
         if add_offset:
             date = datetime(qdate.year(), qdate.month(), qdate.day())
         
-        fields = source.fields()
-        src_crs = source.sourceCrs()
-        if fields.append(QgsField("tzid", QVariant.String)) is False:
-            raise QgsProcessingException("Field names must be unique. There is already a field named 'tzid'")
+        if encode_tzid:
+            new_fields = [("tz_code", QVariant.Int)]
+            codes = ZoneCodes(tzf_instance.getTZF().timezone_names)
+        else:
+            new_fields = [("tzid", QVariant.String)]
         if add_offset:
-            if fields.append(QgsField("tz_offset", QVariant.String)) is False:
-                raise QgsProcessingException("Field names must be unique. There is already a field named 'tz_offset'")
+            new_fields.append(("tz_offset", QVariant.String))
 
-        (sink, dest_id) = self.parameterAsSink(
-            parameters, self.PrmOutputLayer, context, fields,
-            source.wkbType(), src_crs)
+        if self.in_place:
+            layer = self.parameterAsVectorLayer(parameters, self.PrmInputLayer, context)
+            if layer is None:
+                raise QgsProcessingException('Updating in place requires the input to be a vector layer')
+            output = InPlaceUpdater(layer, new_fields, batch_size)
+            # The source is created after the new fields are added so that it
+            # has them, and it keeps the selection and filter of the input
+            source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
+            src_crs = source.sourceCrs()
+            iterator = source.getFeatures(output.request())
+            dest_id = layer.id()
+        else:
+            source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
+            src_crs = source.sourceCrs()
+            builder = OutputFeatureBuilder(source, attributes_only, key_field)
+            for name, field_type in new_fields:
+                builder.addField(name, field_type)
+            (sink, dest_id) = self.parameterAsSink(
+                parameters, self.PrmOutputLayer, context, builder.fields,
+                builder.wkb_type, src_crs)
+            output = BufferedSink(sink, batch_size)
+            iterator = source.getFeatures()
 
         if src_crs != epsg4326:
             transform = QgsCoordinateTransform(src_crs, epsg4326, QgsProject.instance())
-        tzf = tzf_instance.getTZF()
+        else:
+            transform = None
+        tz_index = tzf_instance.getTZIndex(feedback)
+        executor = ShardExecutor(workers, tz_index)
+        offsets = OffsetCache()
         total = 100.0 / source.featureCount() if source.featureCount() else 0
 
-        iterator = source.getFeatures()
-        for cnt, feature in enumerate(iterator):
-            if feedback.isCanceled():
-                break
-            f = QgsFeature()
-            f.setGeometry(feature.geometry())
-            pt = feature.geometry().asPoint()
-            if src_crs != epsg4326:
-                pt = transform.transform(pt)
-            try:
-                msg = tzf.timezone_at(lng=pt.x(), lat=pt.y())
-            except Exception:
-                msg = ''
-            if add_offset:
-                if msg:
-                    try:
-                        tz = ZoneInfo(msg)
-                        loc_dt = date.replace(tzinfo=tz)
-                        offset = loc_dt.strftime('%z')
-                    except Exception:
-                        offset = ''
-                else:
-                    offset = ''
-                f.setAttributes(feature.attributes() + [msg, offset])
-            else:
-                f.setAttributes(feature.attributes() + [msg])
-            sink.addFeature(f)
+        cnt = 0
+        # Points are not snapped across time zone boundaries
+        dedup = CoordinateDeduplicator(tolerance, same_zone=tz_index.sameZone)
+        shards = coordinateShards(iterator, transform, dedup)
+        try:
+            for (chunk, state), results in executor.imap(timezoneShard, shards, feedback):
+                tz_names = dedup.expand(state, results, '')
+                for feature, msg in zip(chunk, tz_names):
+                    values = [codes.code(msg) if encode_tzid else msg]
+                    if add_offset:
+                        values.append(offsets.offset(msg, date))
+                    if self.in_place:
+                        output.updateFeature(feature, values)
+                    else:
+                        output.addFeature(builder.feature(feature, values))
 
-            if cnt % 100 == 0:
+                cnt += len(chunk)
                 feedback.setProgress(int(cnt * total))
+        except Exception:
+            if self.in_place:
+                output.rollBack()
+            raise
+        finally:
+            executor.shutdown()
+        if self.in_place:
+            output.commit()
+        else:
+            output.flush()
 
-        return {self.PrmOutputLayer: dest_id}
+        feedback.pushInfo(dedup.summary())
+        if add_offset:
+            feedback.pushInfo(offsets.summary())
+        results = {self.PrmOutputLayer: dest_id}
+        if encode_tzid:
+            table_id = self.writeLookupTable(parameters, context, codes, date if add_offset else datetime.now())
+            if table_id:
+                results[self.PrmLookupTable] = table_id
+        return results
+
+    def writeLookupTable(self, parameters, context, codes, date):
+        '''Write the tz_code to tzid lookup table with the UTC offset of
+        each zone for date.'''
+        fields = QgsFields()
+        fields.append(QgsField("tz_code", QVariant.Int))
+        fields.append(QgsField("tzid", QVariant.String))
+        fields.append(QgsField("tz_offset", QVariant.String))
+        fields.append(QgsField("offset_sec", QVariant.Int))
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, self.PrmLookupTable, context, fields,
+            QgsWkbTypes.NoGeometry, epsg4326)
+        if sink is None:
+            return None
+        for code, tz_name in codes.usedZones():
+            try:
+                loc_dt = date.replace(tzinfo=ZoneInfo(tz_name))
+                offset = loc_dt.strftime('%z')
+                offset_sec = int(loc_dt.utcoffset().total_seconds())
+            except Exception:
+                offset = ''
+                offset_sec = None
+            f = QgsFeature()
+            f.setAttributes([code, tz_name, offset, offset_sec])
+            sink.addFeature(f)
+        return dest_id
 
     def name(self):
         return 'addtimezoneattributes'
@@ -146,3 +284,23 @@ class AddTimezoneAlgorithm(QgsProcessingAlgorithm):
 
     def createInstance(self):
         return AddTimezoneAlgorithm()
+
+class FillTimezoneInPlaceAlgorithm(AddTimezoneAlgorithm):
+    """
+    Algorithm to fill in the empty time zone attributes of the input layer.
+    """
+
+    in_place = True
+
+    def flags(self):
+        # The project layer is edited, which is only safe in the main thread
+        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading
+
+    def name(self):
+        return 'filltimezoneattributes'
+
+    def displayName(self):
+        return 'Fill in time zone attributes in place'
+
+    def createInstance(self):
+        return FillTimezoneInPlaceAlgorithm()
@@ -9,45 +9,124 @@
  ***************************************************************************/
 """
 import os
-import math
-import datetime
-from datetime import timezone
-import dateutil.parser
-import traceback
+from datetime import datetime, timezone
+from zoneinfo import available_timezones
+import numpy as np
 
-from qgis.core import (
-    QgsPointXY, QgsFeature, QgsGeometry, QgsField,
-    QgsProject, QgsWkbTypes)
+from qgis.core import NULL, QgsFeatureRequest, QgsProject, QgsWkbTypes, QgsCoordinateTransform
 
 from qgis.core import (
     QgsProcessing,
-    QgsProcessingFeatureBasedAlgorithm,
+    QgsProcessingAlgorithm,
     QgsProcessingException,
     QgsProcessingParameterBoolean,
+    QgsProcessingParameterDefinition,
     QgsProcessingParameterEnum,
+    QgsProcessingParameterMatrix,
+    QgsProcessingParameterNumber,
     QgsProcessingParameterString,
-    QgsProcessingParameterField
+    QgsProcessingParameterField,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFeatureSink
     )
 
 from qgis.PyQt.QtGui import QIcon
-from qgis.PyQt.QtCore import QVariant, QUrl, QDateTime, QDate
+from qgis.PyQt.QtCore import Qt, QVariant, QUrl, QDateTime, QDate
 
 from .settings import epsg4326, tzf_instance
+from .pipeline import CHUNK_SIZE, OutputFeatureBuilder, BufferedSink, iterChunks, chunkCoordinates
+from .dtparse import (
+    MEMO_SIZE, SAMPLE_ROWS, SAMPLE_SIZE, ColumnParser, epochsToDatetime64, datetime64ToEpochs,
+    datetimesToDatetime64, datetime64Strings, localStrings, utcOffsets)
+
+INPUT_TYPES = ['Date/time or date object or string', 'Epoch (UNIX timestamp)',
+    'Epoch milliseconds', 'Epoch microseconds', 'Epoch nanoseconds']
+OUTPUT_TYPES = ['Date/time object', 'ISO8601 String', 'Epoch (UNIX timestamp)', 'Date object', 'Date string',
+    'Epoch milliseconds', 'Epoch microseconds', 'Epoch nanoseconds']
+OUTPUT_QVARIANTS = [QVariant.DateTime, QVariant.String, QVariant.Double, QVariant.Date, QVariant.String,
+    QVariant.LongLong, QVariant.LongLong, QVariant.LongLong]
+# Epoch units of the input and output types that are epochs
+INPUT_EPOCH_UNITS = {1: 's', 2: 'ms', 3: 'us', 4: 'ns'}
+OUTPUT_EPOCH_UNITS = {2: 's', 5: 'ms', 6: 'us', 7: 'ns'}
+TIMEZONE_OPTIONS = ['Ignore Timezone', 'UTC', 'Extract timezone from coordinate', 'Use one of the timezones below']
+TIMEZONES = sorted(available_timezones())
+# Julian day number of 1970-01-01
+JULIAN_DAY_EPOCH = 2440588
+
+def datetime64Values(dt64, output_type, offsets=None):
+    '''Convert a UTC datetime64[us] array to a list of attribute values of
+    output_type. If offsets is given the date/times and dates are in the
+    local time with those UTC offsets in seconds. NaT and NaN offsets
+    become NULL. Epochs do not depend on the offsets.'''
+    if output_type in OUTPUT_EPOCH_UNITS:
+        return datetime64ToEpochs(dt64, OUTPUT_EPOCH_UNITS[output_type])
+    if output_type == 1:
+        return datetime64Strings(dt64, 's', 'Z') if offsets is None else localStrings(dt64, offsets)
+    if output_type == 4:
+        return datetime64Strings(dt64, 'D') if offsets is None else localStrings(dt64, offsets, 'D')
+    values = np.full(len(dt64), None, dtype=object)
+    valid = ~np.isnat(dt64)
+    if offsets is not None:
+        valid &= np.isfinite(offsets)
+        offs = offsets[valid].astype(np.int64)
+    if output_type == 0:
+        msecs = dt64[valid].astype('datetime64[ms]').astype(np.int64).tolist()
+        if offsets is None:
+            values[valid] = [QDateTime.fromMSecsSinceEpoch(ms, Qt.UTC) for ms in msecs]
+        else:
+            values[valid] = [QDateTime.fromMSecsSinceEpoch(ms, Qt.OffsetFromUTC, off)
+                for ms, off in zip(msecs, offs.tolist())]
+    else:
+        local = dt64[valid] if offsets is None else dt64[valid] + offs.astype('timedelta64[s]')
+        days = local.astype('datetime64[D]').astype(np.int64).tolist()
+        values[valid] = [QDate.fromJulianDay(day + JULIAN_DAY_EPOCH) for day in days]
+    return values.tolist()
+
+def datetimeValue(newdt, output_type):
+    '''Convert a time zone aware datetime to an attribute value of
+    output_type keeping its UTC offset.'''
+    if output_type == 0:
+        return QDateTime(newdt)
+    if output_type == 1:  # ISO
+        if newdt.utcoffset().total_seconds() == 0:
+            return newdt.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return newdt.strftime('%Y-%m-%dT%H:%M:%S%z')
+    if output_type == 3:  # Date object
+        return QDate(newdt.date())
+    return newdt.strftime('%Y-%m-%d')  # Date string
+
+def optionIndex(value, options, description):
+    '''Index of an option given as its number or its name in a matrix cell'''
+    text = str(value).strip()
+    if text.isdigit() and int(text) < len(options):
+        return int(text)
+    for i, option in enumerate(options):
+        if option.lower() == text.lower():
+            return i
+    raise QgsProcessingException("Unknown {} '{}'. Use a number from 0 to {} or one of: {}".format(
+        description, text, len(options) - 1, ', '.join(options)))
 
-class ConvertDateTimeAlgorithm(QgsProcessingFeatureBasedAlgorithm):
+def isEmpty(value):
+    return value is None or value == NULL or value == ''
+
+class ConvertDateTimeAlgorithm(QgsProcessingAlgorithm):
     """
-    Algorithm to time zone attribute.
+    Algorithm to convert a date/time attribute.
     """
 
+    PrmInputLayer = 'INPUT'
     PrmDateTimeField = 'DateTimeField'
     PrmInputDateTimeType = 'InputDateTimeType'
     PrmHintDayFirst = 'HintDayFirst'
     PrmHintYearFirst = 'HintYearFirst'
     PrmOutputDateTimeType = 'OutputDateTimeType'
     PrmAttributeName = 'AttributeName'
-    PrmOutputLayer = 'OutputLayer'
+    PrmOutputLayer = 'OUTPUT'
     PrmTimezoneOptions = 'TimezoneOptions'
     PrmTimezones = 'Timezones'
+    PrmAdditionalFields = 'AdditionalFields'
+    PrmCacheSize = 'CacheSize'
+    PrmBatchSize = 'BatchSize'
 
     def createInstance(self):
         return ConvertDateTimeAlgorithm()
@@ -61,41 +140,24 @@ class ConvertDateTimeAlgorithm(QgsProcessingFeatureBasedAlgorithm):
     def displayName(self):
         return 'Convert Date/Time'
 
-    def outputName(self):
-        return 'Converted layer'
-
     def helpUrl(self):
         file = os.path.dirname(__file__) + '/index.html'
         if not os.path.exists(file):
             return ''
         return QUrl.fromLocalFile(file).toString(QUrl.FullyEncoded)
 
-    def inputLayerTypes(self):
-        return [QgsProcessing.TypeVector]
-
-    def outputWkbType(self, input_wkb_type):
-        return (input_wkb_type)
-
-    def outputFields(self, input_fields):
-        if self.dt_output_type == 0:
-            input_fields.append(QgsField(self.dt_name, QVariant.DateTime))
-        elif self.dt_output_type == 1 or self.dt_output_type == 4:  # Either a datetime or date string
-            input_fields.append(QgsField(self.dt_name, QVariant.String))
-        elif self.dt_output_type == 2:
-            input_fields.append(QgsField(self.dt_name, QVariant.Double))
-        elif self.dt_output_type == 3:
-            input_fields.append(QgsField(self.dt_name, QVariant.Date))
-        return(input_fields)
-
-    def supportInPlaceEdit(self, layer):
-        return False
-
-    def initParameters(self, config=None):
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.PrmInputLayer,
+                'Input layer',
+                [QgsProcessing.TypeVector])
+        )
         self.addParameter(
             QgsProcessingParameterField(
                 self.PrmDateTimeField,
                 'Input date/time attribute field',
-                parentLayerParameterName='INPUT',
+                parentLayerParameterName=self.PrmInputLayer,
                 type=QgsProcessingParameterField.Any,
                 optional=False)
         )
@@ -103,7 +165,7 @@ class ConvertDateTimeAlgorithm(QgsProcessingFeatureBasedAlgorithm):
             QgsProcessingParameterEnum(
                 self.PrmInputDateTimeType,
                 'Input date/time type',
-                options=['Date/time or date object or string', 'Epoch (UNIX timestamp)'],
+                options=INPUT_TYPES,
                 defaultValue=0,
                 optional=False)
         )
@@ -121,27 +183,27 @@ class ConvertDateTimeAlgorithm(QgsProcessingFeatureBasedAlgorithm):
                 False,
                 optional=True)
         )
-        '''self.addParameter(
+        self.addParameter(
             QgsProcessingParameterEnum(
                 self.PrmTimezoneOptions,
                 'Timezone options',
-                options=['Ignore Timezone', 'UTC', 'Extract timezone from coordinate', 'Use one of the timezones below'],
+                options=TIMEZONE_OPTIONS,
                 defaultValue=0,
-                optional=False)
+                optional=True)
         )
         self.addParameter(
             QgsProcessingParameterEnum(
                 self.PrmTimezones,
                 'Optional timezones',
-                options=all_timezones,
-                defaultValue=0,
+                options=TIMEZONES,
+                defaultValue=TIMEZONES.index('UTC') if 'UTC' in TIMEZONES else 0,
                 optional=True)
-        )'''
+        )
         self.addParameter(
             QgsProcessingParameterEnum(
                 self.PrmOutputDateTimeType,
                 'Output date/time type',
-                options=['Date/time object', 'ISO8601 String', 'Epoch (UNIX timestamp)', 'Date object', 'Date string'],
+                options=OUTPUT_TYPES,
                 defaultValue=0,
                 optional=False)
         )
@@ -152,84 +214,188 @@ class ConvertDateTimeAlgorithm(QgsProcessingFeatureBasedAlgorithm):
                 defaultValue='datetime',
                 optional=False)
         )
+        param = QgsProcessingParameterMatrix(
+            self.PrmAdditionalFields,
+            'Additional fields converted in the same pass (input and output types are option numbers or names)',
+            hasFixedNumberRows=False,
+            headers=['Input field', 'Input type', 'Output type', 'Output name'],
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmCacheSize,
+            'Number of distinct date/time strings kept in the parse cache (0 disables it)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=MEMO_SIZE,
+            minValue=0,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        param = QgsProcessingParameterNumber(
+            self.PrmBatchSize,
+            'Number of features converted and written to the output layer at a time',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=CHUNK_SIZE,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.PrmOutputLayer,
+                'Converted layer')
+        )
 
-    def prepareAlgorithm(self, parameters, context, feedback):
-        self.date_field = self.parameterAsString(parameters, self.PrmDateTimeField, context)
-        feedback.pushInfo('Date Field: {}'.format(self.date_field))
-        self.dt_input_type = self.parameterAsInt(parameters, self.PrmInputDateTimeType, context)
-        self.dt_output_type = self.parameterAsInt(parameters, self.PrmOutputDateTimeType, context)
-        self.hint_day_first = self.parameterAsBool(parameters, self.PrmHintDayFirst, context)
-        self.hint_year_first = self.parameterAsBool(parameters, self.PrmHintYearFirst, context)
-        self.dt_name = self.parameterAsString(parameters, self.PrmAttributeName, context)
-        return True
-        
-    def processFeature(self, feature, context, feedback):
-        dt = feature[self.date_field]
-        try:
-            if isinstance(dt, QDateTime):
-                newdt = dt.toPyDateTime()
-                dt_resolution = 4
-            elif isinstance(dt, QDate):
-                newdt = datetime(dt.year(), dt.month(), dt.day())
-                dt_resolution = 3
-            elif self.dt_input_type == 1:  # User has specified this is UNIX timestamp
-                 newdt = datetime.fromtimestamp(float(dt), timezone.utc)
-            elif isinstance(dt, str):
-                d1 = dateutil.parser.parse(dt, dayfirst=self.hint_day_first, yearfirst=self.hint_year_first,
-                    default=datetime.datetime(datetime.MINYEAR, 1, 1, hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc))
-                d2 = dateutil.parser.parse(dt, dayfirst=self.hint_day_first, yearfirst=self.hint_year_first,
-                    default=datetime.datetime(datetime.MINYEAR, 2, 2, hour=1, minute=1, second=1, microsecond=1, tzinfo=timezone.utc))
-                dt_resolution = self.checkDateTime(d1, d2)
-                newdt = d1
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.PrmInputLayer, context)
+        date_field = self.parameterAsString(parameters, self.PrmDateTimeField, context)
+        feedback.pushInfo('Date Field: {}'.format(date_field))
+        dt_input_type = self.parameterAsInt(parameters, self.PrmInputDateTimeType, context)
+        dt_output_type = self.parameterAsInt(parameters, self.PrmOutputDateTimeType, context)
+        hint_day_first = self.parameterAsBool(parameters, self.PrmHintDayFirst, context)
+        hint_year_first = self.parameterAsBool(parameters, self.PrmHintYearFirst, context)
+        dt_name = self.parameterAsString(parameters, self.PrmAttributeName, context)
+        tz_option = self.parameterAsInt(parameters, self.PrmTimezoneOptions, context)
+        tz_name = TIMEZONES[self.parameterAsInt(parameters, self.PrmTimezones, context)]
+        matrix = self.parameterAsMatrix(parameters, self.PrmAdditionalFields, context)
+        cache_size = self.parameterAsInt(parameters, self.PrmCacheSize, context)
+        batch_size = self.parameterAsInt(parameters, self.PrmBatchSize, context)
+
+        # (field name, input type, output type, output name) of each conversion
+        conversions = [(date_field, dt_input_type, dt_output_type, dt_name)]
+        if len(matrix) % 4:
+            raise QgsProcessingException('Each additional field needs an input field, input type, output type and output name')
+        for i in range(0, len(matrix), 4):
+            name, in_type, out_type, out_name = [str(value).strip() for value in matrix[i:i + 4]]
+            conversions.append((name, optionIndex(in_type, INPUT_TYPES, 'input type'),
+                optionIndex(out_type, OUTPUT_TYPES, 'output type'), out_name))
+        indices = []
+        for name, in_type, out_type, out_name in conversions:
+            index = source.fields().indexOf(name)
+            if index < 0:
+                raise QgsProcessingException("The input layer has no field named '{}'".format(name))
+            if not out_name:
+                raise QgsProcessingException("The conversion of field '{}' needs an output name".format(name))
+            indices.append(index)
+
+        builder = OutputFeatureBuilder(source)
+        for name, in_type, out_type, out_name in conversions:
+            builder.addField(out_name, OUTPUT_QVARIANTS[out_type])
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, self.PrmOutputLayer, context, builder.fields,
+            builder.wkb_type, source.sourceCrs())
+        output = BufferedSink(sink, batch_size)
+
+        transform = None
+        if tz_option == 2:
+            if QgsWkbTypes.geometryType(source.wkbType()) != QgsWkbTypes.PointGeometry:
+                raise QgsProcessingException('Extracting the timezone from the coordinate requires a point layer')
+            if source.sourceCrs() != epsg4326:
+                transform = QgsCoordinateTransform(source.sourceCrs(), epsg4326, QgsProject.instance())
+            tz_index = tzf_instance.getTZIndex(feedback)
+        elif tz_option == 3:
+            feedback.pushInfo('Timezone: {}'.format(tz_name))
+
+        # Each string field has its own inferred layout. Date/time and date
+        # fields need no parser and are not sampled.
+        string_indices = sorted({index for index, conversion in zip(indices, conversions)
+            if conversion[1] == 0 and source.fields().at(index).type() == QVariant.String})
+        samples = self.sampleStrings(source, string_indices)
+        parsers = {index: ColumnParser(samples[index], hint_day_first, hint_year_first, cache_size)
+            for index in string_indices}
+        total = 100.0 / source.featureCount() if source.featureCount() else 0
+
+        cnt = 0
+        invalid = [0] * len(conversions)
+        for chunk in iterChunks(source.getFeatures(), batch_size):
+            if feedback.isCanceled():
+                break
+            if tz_option == 2:
+                # The time zones of the whole chunk are looked up at once
+                lons, lats = chunkCoordinates(chunk, transform)
+                zones = tz_index.timezonesAt(lons, lats)
+            elif tz_option == 3:
+                zones = tz_name
             else:
-                newdt = None
-                dt_resolution = 0
+                zones = None
+            columns = []
+            for i, (index, conversion) in enumerate(zip(indices, conversions)):
+                values = [feature.attribute(index) for feature in chunk]
+                converted = self.convertValues(values, conversion[1], conversion[2], parsers.get(index), tz_option, zones)
+                invalid[i] += sum(1 for value, new_value in zip(values, converted)
+                    if new_value is None and not isEmpty(value))
+                columns.append(converted)
+            for feature, new_values in zip(chunk, zip(*columns)):
+                output.addFeature(builder.feature(feature, new_values))
+
+            cnt += len(chunk)
+            feedback.setProgress(int(cnt * total))
+        output.flush()
+        for index in string_indices:
+            parser = parsers[index]
+            if parser.fast or parser.fallback:
+                feedback.pushInfo('{}: {}'.format(source.fields().at(index).name(), parser.summary()))
+        for count, conversion in zip(invalid, conversions):
+            if count:
+                feedback.pushInfo('{}: {} values could not be converted and were left empty'.format(conversion[0], count))
+
+        return {self.PrmOutputLayer: dest_id}
+
+    def sampleStrings(self, source, indices):
+        '''Return a dictionary with up to SAMPLE_SIZE non-empty strings of
+        each of the attribute indices used to infer the layout of the
+        columns. All the columns are sampled in one read of at most
+        SAMPLE_ROWS features, so sparse columns get a smaller sample.'''
+        samples = {index: [] for index in indices}
+        if not indices:
+            return samples
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(indices).setLimit(SAMPLE_ROWS)
+        for f in source.getFeatures(request):
+            for index in indices:
+                value = f.attribute(index)
+                if isinstance(value, str) and value.strip() and len(samples[index]) < SAMPLE_SIZE:
+                    samples[index].append(value)
+            if all(len(values) >= SAMPLE_SIZE for values in samples.values()):
+                break
+        return samples
+
+    def convertValues(self, values, dt_input_type, dt_output_type, parser, tz_option=0, zones=None):
+        '''Convert the attribute values of a chunk of features. Epoch input
+        and output are converted for the whole chunk at once with NumPy
+        datetime64 arithmetic. Unless the time zone is ignored, the values
+        are converted to UTC or to the local time of zones, a time zone name
+        for all values or the time zone name of each value.'''
+        if dt_input_type in INPUT_EPOCH_UNITS:
+            dt64 = epochsToDatetime64(values, INPUT_EPOCH_UNITS[dt_input_type])
+        else:
+            datetimes = [self.toDatetime(value, parser) for value in values]
+            if tz_option == 0 and dt_output_type not in OUTPUT_EPOCH_UNITS:
+                # Keep the UTC offset of each value
+                return [None if newdt is None else datetimeValue(newdt, dt_output_type) for newdt in datetimes]
+            dt64 = datetimesToDatetime64(datetimes)
+        offsets = None
+        if tz_option >= 2 and dt_output_type not in OUTPUT_EPOCH_UNITS:
+            offsets = utcOffsets(dt64, zones)
+        return datetime64Values(dt64, dt_output_type, offsets)
+
+    def toDatetime(self, value, parser):
+        '''Time zone aware datetime of a date/time, date or string attribute.
+        Values without a time zone are UTC. None if it cannot be converted.'''
+        try:
+            if isinstance(value, QDateTime):
+                if not value.isValid():
+                    return None
+                newdt = value.toPyDateTime()
+                if newdt.tzinfo is None:
+                    newdt = newdt.replace(tzinfo=timezone.utc)
+                return newdt
+            if isinstance(value, QDate):
+                if not value.isValid():
+                    return None
+                return datetime(value.year(), value.month(), value.day(), tzinfo=timezone.utc)
+            if isinstance(value, str) and value.strip():
+                newdt, dt_resolution = parser.parse(value)
+                return newdt if dt_resolution else None
         except Exception:
-            s = traceback.format_exc()
-            feedback.pushInfo(s)
-            newdt = None
-            dt_resolution = 0
-
-        attr = feature.attributes()
-        if newdt == None:
-            attr.append(None)
-        elif self.dt_output_type == 0:
-            qdt = QDateTime(newdt) 
-            attr.append(qdt)
-        elif self.dt_output_type == 1:  # ISO
-            if newdt.tzinfo.utcoffset(newdt).total_seconds() == 0:
-                s = newdt.strftime('%Y-%m-%dT%H:%M:%SZ')
-            else:
-                s = newdt.strftime('%Y-%m-%dT%H:%M:%S%z')
-            # s = '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}'.format(newdt.year, newdt.month, newdt.day, newdt.hour, newdt.minute, newdt.second)
-            attr.append(s)
-        elif self.dt_output_type == 2:  # UNIX Timestamp
-            utc = newdt.astimezone(timezone.utc)
-            dval = utc.timestamp()
-            attr.append(dval)  # This will be a double floating point number
-        elif self.dt_output_type == 3:  # Date object
-            qdate = QDate(newdt.date())
-            attr.append(qdate)
-        elif self.dt_output_type == 4:  # Date string
-            s = newdt.strftime('%Y-%m-%d')
-            attr.append(s)
-        feature.setAttributes(attr)
-        
-        return [feature]
-
-
-    def checkDateTime(self, d1, d2):
-        if d1.year == datetime.MINYEAR:
-            return(0)
-        dt_resolution = 1
-        if d1.month != d2.month:
-            return(dt_resolution)
-        dt_resolution += 1
-        if d1.day != d2.day:
-            return(dt_resolution)
-        dt_resolution += 1
-        if d1.hour != d2.hour:
-            return(dt_resolution)
-        # We have a valid date and time
-        dt_resolution += 1
-        return(dt_resolution)
+            pass
+        return None
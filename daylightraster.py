@@ -0,0 +1,178 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import math
+from datetime import datetime
+import numpy as np
+from osgeo import gdal
+
+from qgis.core import (
+    QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterDateTime,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterExtent,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterRasterDestination)
+
+from qgis.PyQt.QtGui import QIcon
+from qgis.PyQt.QtCore import QUrl
+
+from .settings import epsg4326, tzf_instance
+from .parallel import ShardExecutor, daylightBlockShard
+
+QUANTITIES = ['Day length (hours)', 'Sunrise (hours after midnight)', 'Sunset (hours after midnight)']
+QUANTITY_NAMES = ['daylength', 'sunrise', 'sunset']
+NODATA = -9999.0
+# Number of pixels computed and written at a time
+BLOCK_CELLS = 1000000
+
+class DaylightRasterAlgorithm(QgsProcessingAlgorithm):
+    """
+    Algorithm to create a raster of day length, sunrise or sunset for a date.
+    """
+
+    PrmExtent = 'Extent'
+    PrmResolution = 'Resolution'
+    PrmDate = 'Date'
+    PrmQuantity = 'Quantity'
+    PrmUseUTC = 'UseUTC'
+    PrmWorkers = 'Workers'
+    PrmOutputRaster = 'OutputRaster'
+
+    def initAlgorithm(self, config):
+        self.addParameter(
+            QgsProcessingParameterExtent(
+                self.PrmExtent,
+                'Extent',
+                defaultValue='-180,180,-90,90 [EPSG:4326]')
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmResolution,
+                'Pixel size in degrees',
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.1,
+                minValue=0.0001)
+        )
+        self.addParameter(
+            QgsProcessingParameterDateTime(
+                self.PrmDate,
+                'Select date for solar calculations',
+                type=QgsProcessingParameterDateTime.Date,
+                optional=False,
+                )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PrmQuantity,
+                'Raster values',
+                options=QUANTITIES,
+                defaultValue=0,
+                optional=False)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PrmUseUTC,
+                'Use UTC for sunrise and sunset (otherwise the local time of each pixel)',
+                True,
+                optional=True)
+        )
+        param = QgsProcessingParameterNumber(
+            self.PrmWorkers,
+            'Number of worker processes (1 runs in the QGIS process)',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            optional=True)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(param)
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                self.PrmOutputRaster,
+                'Output GeoTIFF')
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        extent = self.parameterAsExtent(parameters, self.PrmExtent, context, epsg4326)
+        res = self.parameterAsDouble(parameters, self.PrmResolution, context)
+        dt = self.parameterAsDateTime(parameters, self.PrmDate, context)
+        quantity = QUANTITY_NAMES[self.parameterAsInt(parameters, self.PrmQuantity, context)]
+        use_utc = self.parameterAsBool(parameters, self.PrmUseUTC, context)
+        workers = self.parameterAsInt(parameters, self.PrmWorkers, context)
+        out_path = self.parameterAsOutputLayer(parameters, self.PrmOutputRaster, context)
+        qdate = dt.date()
+        if not qdate.isValid():
+            raise QgsProcessingException('Use a proper date and rerun algorithm')
+        date = datetime(qdate.year(), qdate.month(), qdate.day())
+        if os.path.splitext(out_path)[1].lower() not in ('.tif', '.tiff'):
+            # The raster is always written by the GeoTIFF driver
+            raise QgsProcessingException('The output raster must be a GeoTIFF (.tif) file')
+
+        xmin = max(extent.xMinimum(), -180.0)
+        xmax = min(extent.xMaximum(), 180.0)
+        ymin = max(extent.yMinimum(), -90.0)
+        ymax = min(extent.yMaximum(), 90.0)
+        width = int(math.ceil((xmax - xmin) / res))
+        height = int(math.ceil((ymax - ymin) / res))
+        if width <= 0 or height <= 0:
+            raise QgsProcessingException('The extent does not overlap the globe')
+        feedback.pushInfo('Creating a {} x {} pixel raster'.format(width, height))
+
+        driver = gdal.GetDriverByName('GTiff')
+        ds = driver.Create(out_path, width, height, 1, gdal.GDT_Float32,
+            options=['COMPRESS=DEFLATE', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
+        if ds is None:
+            raise QgsProcessingException('Unable to create {}'.format(out_path))
+        ds.SetGeoTransform([xmin, res, 0, ymax, 0, -res])
+        ds.SetProjection(epsg4326.toWkt())
+        band = ds.GetRasterBand(1)
+        band.SetNoDataValue(NODATA)
+
+        # Pixel centers. The last column and row overhang the extent when it is
+        # not a multiple of the pixel size, so their centers are kept on the globe.
+        xs = np.clip(xmin + (np.arange(width) + 0.5) * res, -180.0, 180.0)
+        rows = max(1, BLOCK_CELLS // width)
+        shards = ((yoff, (xs, np.clip(ymax - (np.arange(yoff, min(yoff + rows, height)) + 0.5) * res, -90.0, 90.0),
+            date, quantity, use_utc)) for yoff in range(0, height, rows))
+        local = quantity != 'daylength' and not use_utc
+        executor = ShardExecutor(workers, tzf_instance.getTZIndex(feedback) if local else None)
+        try:
+            for yoff, block in executor.imap(daylightBlockShard, shards, feedback):
+                band.WriteArray(np.where(np.isnan(block), NODATA, block), 0, yoff)
+                feedback.setProgress(int(100.0 * (yoff + block.shape[0]) / height))
+        finally:
+            executor.shutdown()
+            band.FlushCache()
+            band = None
+            ds = None
+
+        return {self.PrmOutputRaster: out_path}
+
+    def name(self):
+        return 'daylightraster'
+
+    def displayName(self):
+        return 'Create daylight raster'
+
+    def icon(self):
+        return QIcon(os.path.dirname(__file__) + '/images/sun.svg')
+
+    def helpUrl(self):
+        file = os.path.dirname(__file__) + '/index.html'
+        if not os.path.exists(file):
+            return ''
+        return QUrl.fromLocalFile(file).toString(QUrl.FullyEncoded)
+
+    def createInstance(self):
+        return DaylightRasterAlgorithm()
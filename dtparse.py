@@ -0,0 +1,332 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import re
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone, MINYEAR
+import numpy as np
+import dateutil.parser
+
+from .tzlookup import zoneOffsets
+
+# Number of non-empty values of a column used to infer its layout
+SAMPLE_SIZE = 200
+# Maximum number of rows read to collect the sample of the string columns
+SAMPLE_ROWS = 10000
+# Default number of distinct strings whose parse results are kept
+MEMO_SIZE = 100000
+
+# Epoch units and the number of microseconds in each. Converted date/times
+# are held as datetime64[us] so that years 1 to 9999 are supported.
+EPOCH_UNITS = ['s', 'ms', 'us', 'ns']
+EPOCH_US = {'s': 1000000, 'ms': 1000, 'us': 1, 'ns': 0.001}
+# Microseconds of 0001-01-01 and 9999-12-31T23:59:59.999999 since the epoch
+MIN_EPOCH_US = -62135596800000000
+MAX_EPOCH_US = 253402300799999999
+# Range of datetime64[ns] which is also the range of nanosecond epochs
+MIN_NS_US = -9223372036854775
+MAX_NS_US = 9223372036854775
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Resolution of a parsed date/time: 0 invalid, 1 year, 2 month, 3 day, 4 time
+RES_INVALID = 0
+RES_DATE = 3
+RES_TIME = 4
+
+ISO_PATTERN = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d{1,6})\d*)?)?)?'
+    r'\s*(Z|[+-]\d{2}(?::?\d{2})?)?$')
+
+_TIMES = ['%H:%M:%S.%f', '%H:%M:%S', '%H:%M', '%I:%M:%S %p', '%I:%M %p']
+
+def _layouts(dates):
+    return [d + ' ' + t for d in dates for t in _TIMES] + list(dates)
+
+# strptime layouts tried after ISO 8601. Month first and day first layouts
+# of the same shape are ordered by the day first hint like dateutil.
+MONTH_FIRST = _layouts(['%m/%d/%Y', '%m-%d-%Y', '%m.%d.%Y'])
+DAY_FIRST = _layouts(['%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y'])
+OTHER_LAYOUTS = _layouts(['%Y/%m/%d', '%Y.%m.%d', '%d %b %Y', '%d %B %Y', '%b %d, %Y', '%B %d, %Y', '%d-%b-%Y']) + [
+    '%Y%m%dT%H%M%S', '%Y%m%d%H%M%S', '%Y%m%d', '%Y-%m', '%Y']
+
+def layoutResolution(layout):
+    '''Resolution of the values parsed with a strptime layout'''
+    if '%H' in layout or '%I' in layout:
+        return RES_TIME
+    if '%d' in layout:
+        return RES_DATE
+    if '%m' in layout or '%b' in layout or '%B' in layout:
+        return 2
+    return 1
+
+def parseISO(value):
+    '''Parse an ISO 8601 date or date/time with the compiled ISO_PATTERN.
+    Returns (datetime, resolution) or None if it does not match. Values
+    without a time zone are UTC.'''
+    match = ISO_PATTERN.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, tz = match.groups()
+    if tz is None or tz == 'Z':
+        tzinfo = timezone.utc
+    else:
+        sign = -1 if tz[0] == '-' else 1
+        digits = tz[1:].replace(':', '')
+        tzinfo = timezone(sign * timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0)))
+    if hour is None:
+        return datetime(int(year), int(month), int(day), tzinfo=tzinfo), RES_DATE
+    microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+        int(second or 0), microsecond, tzinfo=tzinfo), RES_TIME
+
+def dateutilParse(value, dayfirst=False, yearfirst=False):
+    '''Parse any date/time string with dateutil. The string is parsed with
+    two different defaults to find which parts were given. Returns
+    (datetime, resolution); invalid strings raise an exception.'''
+    d1 = dateutil.parser.parse(value, dayfirst=dayfirst, yearfirst=yearfirst,
+        default=datetime(MINYEAR, 1, 1, hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc))
+    d2 = dateutil.parser.parse(value, dayfirst=dayfirst, yearfirst=yearfirst,
+        default=datetime(MINYEAR, 2, 2, hour=1, minute=1, second=1, microsecond=1, tzinfo=timezone.utc))
+    if d1.year == MINYEAR:
+        return d1, RES_INVALID
+    if d1.month != d2.month:
+        return d1, 1
+    if d1.day != d2.day:
+        return d1, 2
+    if d1.hour != d2.hour:
+        return d1, RES_DATE
+    return d1, RES_TIME
+
+def inferLayout(samples, dayfirst=False):
+    '''Return the first layout that parses every sample string: 'ISO' for
+    ISO 8601 or a strptime format. None if there is no consistent layout.'''
+    samples = [s.strip() for s in samples if s and s.strip()]
+    if not samples:
+        return None
+    if all(ISO_PATTERN.match(s) for s in samples):
+        return 'ISO'
+    layouts = (DAY_FIRST + MONTH_FIRST if dayfirst else MONTH_FIRST + DAY_FIRST) + OTHER_LAYOUTS
+    for layout in layouts:
+        try:
+            for s in samples:
+                datetime.strptime(s, layout)
+            return layout
+        except ValueError:
+            continue
+    return None
+
+class ColumnParser():
+    '''Parse the date/time strings of a column. The layout is inferred once
+    from a sample of the column and every value is parsed with the compiled
+    ISO 8601 pattern or the strptime format of that layout. Values that do
+    not match fall back to dateutil. The results of the last memo_size
+    distinct strings are kept in an LRU memo so repeated values are not
+    parsed again. The counts are kept so the fallback rate and memo hit
+    rate can be reported.'''
+    def __init__(self, samples, dayfirst=False, yearfirst=False, memo_size=MEMO_SIZE):
+        self.dayfirst = dayfirst
+        self.yearfirst = yearfirst
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.layout = inferLayout(samples, dayfirst)
+        if self.layout is not None and self.layout != 'ISO':
+            self.resolution = layoutResolution(self.layout)
+        self.fast = 0
+        self.fallback = 0
+        self.failed = 0
+
+    def parse(self, value):
+        '''Returns (datetime, resolution). Invalid strings raise a ValueError.'''
+        key = (value, self.dayfirst, self.yearfirst)
+        self.lookups += 1
+        try:
+            result = self.memo[key]
+            self.hits += 1
+            self.memo.move_to_end(key)
+        except KeyError:
+            try:
+                result = self.parseValue(value)
+            except Exception:
+                # Invalid strings are remembered too
+                result = None
+            if self.memo_size > 0:
+                self.memo[key] = result
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+                    self.evictions += 1
+        if result is None:
+            raise ValueError('Unknown date/time string: {}'.format(value))
+        return result
+
+    def parseValue(self, value):
+        value = value.strip()
+        if self.layout == 'ISO':
+            try:
+                result = parseISO(value)
+            except ValueError:
+                result = None
+            if result is not None:
+                self.fast += 1
+                return result
+        elif self.layout is not None:
+            try:
+                dt = datetime.strptime(value, self.layout)
+                self.fast += 1
+                if dt.tzinfo is None:
+                    dt = dt.replace(tzinfo=timezone.utc)
+                return dt, self.resolution
+            except ValueError:
+                pass
+        self.fallback += 1
+        try:
+            return dateutilParse(value, self.dayfirst, self.yearfirst)
+        except Exception:
+            self.failed += 1
+            raise
+
+    def summary(self):
+        total = self.fast + self.fallback
+        rate = 100.0 * self.fallback / total if total else 0.0
+        layout = {None: 'none', 'ISO': 'ISO 8601'}.get(self.layout, self.layout)
+        text = 'Inferred layout: {}, {} strings parsed with it, {} with dateutil ({:.1f}% fallback rate), {} invalid'.format(
+            layout, self.fast, self.fallback, rate, self.failed)
+        rate = 100.0 * self.hits / self.lookups if self.lookups else 0.0
+        text += '\nParse cache: {} lookups, {} hits ({:.1f}% hit rate), {} evictions'.format(
+            self.lookups, self.hits, rate, self.evictions)
+        return text
+
+def epochsToDatetime64(values, unit='s'):
+    '''Convert a sequence of epoch numbers in unit ('s', 'ms', 'us' or 'ns')
+    to a datetime64[us] array. Integer values are converted exactly and the
+    other values through float. Both round down to the microsecond. NULL,
+    non numeric and out of range values become NaT.'''
+    n = len(values)
+    us = np.zeros(n, dtype=np.int64)
+    valid = np.zeros(n, dtype=bool)
+    # The integers are converted separately so that a NULL or a float in the
+    # same chunk does not send them through float64
+    is_int = np.fromiter((type(v) is int and -2 ** 63 <= v < 2 ** 63 for v in values), dtype=bool, count=n)
+    index = np.flatnonzero(is_int)
+    if len(index):
+        ints = np.array([values[i] for i in index], dtype=np.int64)
+        if unit == 'ns':
+            ok = np.ones(len(ints), dtype=bool)
+            us[index] = ints // 1000
+        else:
+            factor = EPOCH_US[unit]
+            ok = (ints >= -(-MIN_EPOCH_US // factor)) & (ints <= MAX_EPOCH_US // factor)
+            us[index[ok]] = ints[ok] * factor
+        valid[index[ok]] = True
+    index = np.flatnonzero(~is_int)
+    if len(index):
+        others = [values[i] for i in index]
+        try:
+            floats = np.array(others, dtype=np.float64)
+        except (TypeError, ValueError):
+            floats = np.full(len(others), np.nan)
+            for i, v in enumerate(others):
+                try:
+                    floats[i] = float(v)
+                except (TypeError, ValueError):
+                    pass
+        floats = np.floor(floats * EPOCH_US[unit])
+        with np.errstate(invalid='ignore'):
+            ok = (floats >= MIN_EPOCH_US) & (floats <= MAX_EPOCH_US)
+        us[index[ok]] = floats[ok].astype(np.int64)
+        valid[index[ok]] = True
+    result = us.astype('datetime64[us]')
+    result[~valid] = np.datetime64('NaT')
+    return result
+
+def datetime64ToEpochs(dt64, unit='s'):
+    '''Convert a datetime64[us] array to a list of epoch values in unit.
+    Seconds are floats like datetime.timestamp() and the other units are
+    integers. NaT and dates outside of the nanosecond range for 'ns' become None.'''
+    us = dt64.astype(np.int64)
+    valid = ~np.isnat(dt64)
+    if unit == 'ns':
+        valid &= (us >= MIN_NS_US) & (us <= MAX_NS_US)
+    result = np.full(len(dt64), None, dtype=object)
+    if unit == 's':
+        result[valid] = (us[valid] / 1e6).tolist()
+    elif unit == 'ms':
+        result[valid] = (us[valid] // 1000).tolist()
+    elif unit == 'us':
+        result[valid] = us[valid].tolist()
+    else:
+        result[valid] = (us[valid] * 1000).tolist()
+    return result.tolist()
+
+def datetimesToDatetime64(values):
+    '''Convert a list of time zone aware datetimes (or None) to a UTC
+    datetime64[us] array.'''
+    us = np.zeros(len(values), dtype=np.int64)
+    valid = np.zeros(len(values), dtype=bool)
+    for i, dt in enumerate(values):
+        if dt is not None:
+            us[i] = (dt - UNIX_EPOCH) // timedelta(microseconds=1)
+            valid[i] = True
+    result = us.astype('datetime64[us]')
+    result[~valid] = np.datetime64('NaT')
+    return result
+
+def datetime64Strings(dt64, unit='s', suffix=''):
+    '''ISO 8601 strings of a datetime64 array to unit ('s' for date/times,
+    'D' for dates) with suffix appended. NaT becomes None.'''
+    result = np.full(len(dt64), None, dtype=object)
+    valid = ~np.isnat(dt64)
+    if valid.any():
+        result[valid] = np.char.add(np.datetime_as_string(dt64[valid], unit=unit), suffix).tolist()
+    return result.tolist()
+
+def utcOffsets(dt64, tz_names):
+    '''UTC offsets in seconds at each value of a UTC datetime64 array.
+    tz_names is either one time zone name for all values or the time zone
+    name of each value. The offsets of each zone are looked up in its
+    cached transition table. Unknown time zones and NaT give NaN.'''
+    missing = np.isnat(dt64)
+    epochs = dt64.astype('datetime64[s]').astype(np.int64).astype(np.float64)
+    epochs[missing] = np.nan
+    if isinstance(tz_names, str):
+        return zoneOffsets(tz_names, epochs)
+    offsets = np.full(len(epochs), np.nan)
+    zones, inverse = np.unique(np.asarray(tz_names, dtype=str), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for i, tz_name in enumerate(zones):
+        mask = inverse == i
+        offsets[mask] = zoneOffsets(tz_name, epochs[mask])
+    return offsets
+
+def offsetString(offset):
+    '''Z for UTC or the +HHMM form of an offset in seconds'''
+    if offset == 0:
+        return 'Z'
+    return '{}{:02d}{:02d}'.format('-' if offset < 0 else '+', abs(offset) // 3600, abs(offset) % 3600 // 60)
+
+def localStrings(dt64, offsets, unit='s'):
+    '''ISO 8601 strings of a UTC datetime64 array in the local time given
+    by the offsets in seconds. Date/times (unit 's') end with their offset
+    and dates (unit 'D') are the local date. NaT and NaN offsets become None.'''
+    result = np.full(len(dt64), None, dtype=object)
+    valid = ~np.isnat(dt64) & np.isfinite(offsets)
+    if not valid.any():
+        return result.tolist()
+    offs = offsets[valid].astype(np.int64)
+    stamps = np.datetime_as_string(dt64[valid] + offs.astype('timedelta64[s]'), unit=unit)
+    if unit == 's':
+        unique_offs, inverse = np.unique(offs, return_inverse=True)
+        zstrings = np.array([offsetString(o) for o in unique_offs.tolist()])
+        stamps = np.char.add(stamps, zstrings[inverse.reshape(-1)])
+    result[valid] = stamps.tolist()
+    return result.tolist()
@@ -0,0 +1,197 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import calendar
+from datetime import timedelta, timezone
+from functools import lru_cache
+from math import cos, pi, radians, sin
+from zoneinfo import ZoneInfo
+import numpy as np
+from astral.location import LocationInfo
+from astral.moon import MOON_APPARENT_RADIUS, interpolate, moon_position, moonrise, moonset, phase
+from astral.julian import julianday, julianday_2000
+from astral.sidereal import gmst
+
+from .solar import formatEpochs, localOffsets, zoneGroups
+
+MOON_EVENTS = ['moonrise', 'moonset']
+MOON_ENGINES = ['NumPy (vectorized, date-shared ephemeris)', 'Astral library (reference)']
+# Sidereal hour angle change per hour in radians
+SIDEREAL_HOUR = radians(15 * 1.0027379097096138907193594760917)
+
+def moonTimesAstral(lons, lats, date, tz_names, fmt):
+    '''Return a list with the formatted moonrise and moonset times of each
+    coordinate computed by astral. Events that do not occur on the date
+    get empty strings.'''
+    results = []
+    for i in range(len(lons)):
+        try:
+            observer = LocationInfo('','','',lats[i], lons[i]).observer
+            tz = timezone.utc if tz_names is None else ZoneInfo(tz_names[i])
+        except Exception:
+            results.append([''] * len(MOON_EVENTS))
+            continue
+        row = []
+        for func in (moonrise, moonset):
+            try:
+                when = func(observer, date, tzinfo=tz)
+                row.append(when.strftime(fmt) if when else '')
+            except Exception:
+                row.append('')
+        results.append(row)
+    return results
+
+class LunarEphemeris():
+    '''The terms of the astral moonrise and moonset calculation that only
+    depend on the date: the right ascension and declination of the moon
+    at each hour of the UTC day, the Greenwich mean sidereal time and the
+    horizon correction for the parallax of the moon. They are computed
+    once per date and shared by all points.'''
+    def __init__(self, day):
+        jd2000 = julianday_2000(day)
+        m = [moon_position(jd2000 + interval * 0.5) for interval in range(3)]
+        for interval in range(1, 3):
+            if m[interval].right_ascension <= m[interval - 1].right_ascension:
+                m[interval].right_ascension += 2 * pi
+        ras = [m[0].right_ascension]
+        decs = [m[0].declination]
+        for hour in range(24):
+            ph = (hour + 1) / 24
+            ra = interpolate(m[0].right_ascension, m[1].right_ascension, m[2].right_ascension, ph)
+            if ra < ras[-1]:
+                ra += 2 * pi
+            ras.append(ra)
+            decs.append(interpolate(m[0].declination, m[1].declination, m[2].declination, ph))
+        self.ras = ras
+        self.sin_decs = [sin(d) for d in decs]
+        self.cos_decs = [cos(d) for d in decs]
+        # The declination half way through each hour
+        self.sin_mid_decs = [sin((decs[h + 1] + decs[h]) / 2) for h in range(24)]
+        self.cos_mid_decs = [cos((decs[h + 1] + decs[h]) / 2) for h in range(24)]
+        self.gmst = gmst(day)
+        self.z = cos(radians(90 + MOON_APPARENT_RADIUS - (41.685 / m[1].distance)))
+
+@lru_cache(maxsize=64)
+def lunarEphemeris(day):
+    return LunarEphemeris(day)
+
+def moonRiseSet(lons, lats, day):
+    '''Vectorized version of the astral riseset function. Returns the
+    minutes after 00:00 UTC of day of the moonrise and moonset of each
+    point (NaN if there is none) and a mask of the points where astral
+    raises an error.'''
+    eph = lunarEphemeris(day)
+    mst = np.radians(eph.gmst + np.asarray(lons, dtype=np.float64))
+    lat_rad = np.radians(np.asarray(lats, dtype=np.float64))
+    sl = np.sin(lat_rad)
+    cl = np.cos(lat_rad)
+    n = len(mst)
+    rise = np.full(n, np.nan)
+    sett = np.full(n, np.nan)
+    error = np.zeros(n, dtype=bool)
+    ha0 = mst - eph.ras[0] + 0 * SIDEREAL_HOUR
+    d0 = sl * eph.sin_decs[0] + cl * eph.cos_decs[0] * np.cos(ha0) - eph.z
+    for hour in range(24):
+        ha0 = mst - eph.ras[hour] + (hour * SIDEREAL_HOUR)
+        ha2 = mst - eph.ras[hour + 1] + (hour * SIDEREAL_HOUR) + SIDEREAL_HOUR
+        d2 = sl * eph.sin_decs[hour + 1] + cl * eph.cos_decs[hour + 1] * np.cos(ha2) - eph.z
+        crossing = np.flatnonzero(np.sign(d0) != np.sign(d2))
+        if len(crossing):
+            c0 = d0[crossing]
+            c2 = d2[crossing]
+            d1 = (sl[crossing] * eph.sin_mid_decs[hour] + cl[crossing] * eph.cos_mid_decs[hour]
+                * np.cos((ha2[crossing] + ha0[crossing]) / 2) - eph.z)
+            a = 2 * c2 - 4 * d1 + 2 * c0
+            b = 4 * d1 - 3 * c0 - c2
+            discriminant = b * b - 4 * a * c0
+            with np.errstate(invalid='ignore', divide='ignore'):
+                root = np.sqrt(discriminant)
+                e = (-b + root) / (2 * a)
+                e = np.where((e > 1) | (e < 0), (-b - root) / (2 * a), e)
+            time = hour + e + 1 / 120
+            found = discriminant >= 0
+            # astral cannot create a time outside of the day and raises an error
+            error[crossing[found & ~((time >= 0) & (time < 24))]] = True
+            h = np.floor(time)
+            event = h * 60 + np.floor((time - h) * 60)
+            query = hour * 60
+            for times, other, kind in ((rise, sett, (c0 < 0) & (c2 > 0)), (sett, rise, (c0 > 0) & (c2 < 0))):
+                idx = crossing[found & kind]
+                new = event[found & kind]
+                current = times[idx]
+                q_diff = current - query
+                e_diff = new - query
+                o_diff = np.nan_to_num(other[idx] - query, nan=0.0)
+                update = np.isnan(current)
+                update |= (np.sign(q_diff) == np.sign(e_diff)) & (np.abs(q_diff) > np.abs(e_diff))
+                update |= (np.sign(q_diff) != np.sign(e_diff)) & ~np.isnan(other[idx]) & (np.sign(q_diff) == np.sign(o_diff))
+                times[idx[update]] = new[update]
+        d0 = d2
+    return rise, sett, error
+
+def moonEvents(lons, lats, date, tz_names=None):
+    '''Compute the moonrise and moonset of whole coordinate arrays the same
+    way as astral. Returns two dictionaries keyed by event name with the
+    UTC epoch seconds and the UTC offset in seconds of each time. Like
+    astral, if an event falls on another date in the time zone of the point
+    (UTC if tz_names is None) the next or previous day is searched. Events
+    that do not occur are NaN.'''
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    base = calendar.timegm((date.year, date.month, date.day, 0, 0, 0))
+    groups = zoneGroups(tz_names)
+    rise, sett, error = moonRiseSet(lons, lats, date)
+    epochs = {}
+    offsets = {}
+    for i, event in enumerate(MOON_EVENTS):
+        minutes = (rise, sett)[i]
+        epoch = base + minutes * 60.0
+        epoch[error] = np.nan
+        offset = localOffsets(epoch, groups)
+        local_day = np.floor((epoch + offset) / 86400.0)
+        for delta in (1, -1):
+            redo = np.flatnonzero((local_day - base // 86400) * delta < 0)
+            if not len(redo):
+                continue
+            retry = moonRiseSet(lons[redo], lats[redo], date + timedelta(days=delta))
+            retry_epoch = base + delta * 86400 + retry[i] * 60.0
+            retry_offset = localOffsets(retry_epoch, None if groups is None else (groups[0], groups[1][redo]))
+            retry_day = np.floor((retry_epoch + retry_offset) / 86400.0)
+            # astral keeps the first time if there is none on the other day
+            found = ~np.isnan(retry_epoch)
+            epoch[redo[found]] = np.where(retry_day[found] == base // 86400, retry_epoch[found], np.nan)
+            epoch[redo[retry[2]]] = np.nan
+        offset = localOffsets(epoch, groups)
+        epoch[~np.isfinite(offset)] = np.nan
+        epochs[event] = epoch
+        offsets[event] = offset
+    return epochs, offsets
+
+def moonPhase(date):
+    '''astral moon phase (0 to 27.99) of date'''
+    return phase(date)
+
+def moonIllumination(date):
+    '''Illuminated fraction of the moon at 00:00 UTC of date, from the
+    elongation of the moon used by the astral phase without rounding.'''
+    jd = julianday(date)
+    dt = pow((jd - 2382148), 2) / (41048480 * 86400)
+    t = (jd + dt - 2451545.0) / 36525
+    d = radians((297.85 + (445267.1115 * t) - (0.0016300 * t * t) + (t ** 3 / 545868)) % 360.0)
+    m = radians((357.53 + (35999.0503 * t)) % 360.0)
+    m1 = radians((134.96 + (477198.8676 * t) + (0.0089970 * t * t) + (t ** 3 / 69699)) % 360.0)
+    elong = d + radians(6.29 * sin(m1) - 2.10 * sin(m) + 1.27 * sin(2 * d - m1) + 0.66 * sin(2 * d))
+    return (1.0 - cos(elong)) / 2.0
+
+def moonTimesNumpy(lons, lats, date, tz_names, fmt):
+    '''NumPy version of moonTimesAstral'''
+    epochs, offsets = moonEvents(lons, lats, date, tz_names)
+    columns = [formatEpochs(epochs[event], offsets[event], tz_names, fmt) for event in MOON_EVENTS]
+    return np.column_stack(columns).tolist() if len(lons) else []
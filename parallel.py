@@ -0,0 +1,156 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import sys
+import multiprocessing
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .tzlookup import TimezoneGridIndex
+from .lunar import moonTimesAstral, moonTimesNumpy
+from .solar import SUN_EVENTS, dayLength, daylightClasses, eventHours, snapError, sunPosition, sunEpochsAstral, sunEpochsNumpy, sunTimesAstral, sunTimesNumpy, sunTimesAstralRange, sunTimesNumpyRange
+
+# This module must not import qgis as it is loaded by the worker processes.
+
+# Time zone index of a worker process, set by initWorker. In the QGIS process
+# the index of each run is passed to the shard functions instead.
+_tz_index = None
+
+def pythonExecutable():
+    '''Inside QGIS sys.executable is the QGIS application and not a Python
+    interpreter that can be used to spawn the worker processes.'''
+    exe = sys.executable
+    if os.path.basename(exe).lower().startswith('python'):
+        return exe
+    if sys.platform == 'win32':
+        candidate = os.path.join(sys.exec_prefix, 'pythonw.exe')
+    else:
+        candidate = os.path.join(sys.exec_prefix, 'bin', 'python3')
+    return candidate if os.path.exists(candidate) else exe
+
+def initWorker(grid, names, resolution):
+    '''Each worker process creates its own TimezoneFinder and grid index.'''
+    global _tz_index
+    if grid is None:
+        return
+    from timezonefinder import TimezoneFinder
+    _tz_index = TimezoneGridIndex(TimezoneFinder(), resolution=resolution, grid=grid, names=names)
+
+def shardZones(lons, lats, tz_index=None):
+    '''Time zone names of the coordinates looked up in tz_index or, in a
+    worker process, in the index created by initWorker.'''
+    return (_tz_index if tz_index is None else tz_index).timezonesAt(lons, lats)
+
+def timezoneShard(lons, lats, tz_index=None):
+    return shardZones(lons, lats, tz_index)
+
+def sunShard(lons, lats, date, use_utc, fmt, engine=0, events=SUN_EVENTS, tz_index=None):
+    tz_names = None if use_utc else shardZones(lons, lats, tz_index)
+    if engine == 0:
+        return sunTimesNumpy(lons, lats, date, tz_names, fmt, events)
+    return sunTimesAstral(lons, lats, date, tz_names, fmt, events)
+
+def moonShard(lons, lats, date, use_utc, fmt, engine=0, tz_index=None):
+    tz_names = None if use_utc else shardZones(lons, lats, tz_index)
+    if engine == 0:
+        return moonTimesNumpy(lons, lats, date, tz_names, fmt)
+    return moonTimesAstral(lons, lats, date, tz_names, fmt)
+
+def sunRangeShard(lons, lats, date, days, use_utc, fmt, engine=0, events=SUN_EVENTS, tz_index=None):
+    tz_names = None if use_utc else shardZones(lons, lats, tz_index)
+    if engine == 0:
+        return sunTimesNumpyRange(lons, lats, date, days, tz_names, fmt, events)
+    return sunTimesAstralRange(lons, lats, date, days, tz_names, fmt, events)
+
+def sunEpochShard(lons, lats, date, days, use_utc, engine=0, events=SUN_EVENTS, tz_index=None):
+    tz_names = None if use_utc else shardZones(lons, lats, tz_index)
+    if engine == 0:
+        return sunEpochsNumpy(lons, lats, date, days, tz_names, events)
+    return sunEpochsAstral(lons, lats, date, days, tz_names, events)
+
+def snapErrorShard(lons, lats, date, tolerance, days, events, func, *args, tz_index=None):
+    '''Run the sun shard function func(lons, lats, date, *args) on locations
+    snapped to a tolerance degree grid and also return the largest error
+    of the events introduced by the snapping at each location.'''
+    return func(lons, lats, date, *args, tz_index=tz_index), snapError(lons, lats, date, days, tolerance, events)
+
+def daylightBlockShard(xs, ys, date, quantity, use_utc, tz_index=None):
+    '''Compute a block of the daylight raster with rows ys and columns xs.
+    quantity is 'daylength' or the event whose hour is computed.'''
+    lons, lats = np.meshgrid(xs, ys)
+    lons = lons.ravel()
+    lats = lats.ravel()
+    if quantity == 'daylength':
+        values = dayLength(lons, lats, date)
+    else:
+        tz_names = None if use_utc else shardZones(lons, lats, tz_index)
+        values = eventHours(lons, lats, date, quantity, tz_names)
+    return values.reshape(len(ys), len(xs)).astype(np.float32)
+
+def sunPositionShard(lons, lats, epochs):
+    return sunPosition(lons, lats, epochs)
+
+def daylightShard(lons, lats, epochs):
+    return daylightClasses(lons, lats, epochs)
+
+class ShardExecutor():
+    '''Runs the shard functions of this module either in the current process
+    (workers <= 1) or in a pool of worker processes. Results are returned in
+    the same order as the shards were submitted. tz_index is only needed
+    by shard functions that look up time zones. In the current process it
+    is passed to them as their tz_index argument, so concurrent runs do
+    not share it.'''
+    def __init__(self, workers, tz_index=None):
+        self.workers = workers
+        self.tz_index = tz_index
+        self.pool = None
+        if workers > 1:
+            if tz_index is None:
+                initargs = (None, None, None)
+            else:
+                initargs = (tz_index.grid, tz_index.names.astype(str), tz_index.resolution)
+            ctx = multiprocessing.get_context('spawn')
+            ctx.set_executable(pythonExecutable())
+            self.pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=ctx, initializer=initWorker, initargs=initargs)
+
+    def imap(self, func, shards, feedback):
+        '''shards is an iterable of (context, args) tuples. For each shard
+        (context, func(*args)) is yielded. At most two shards per worker are
+        in flight so memory stays bounded. Stops when feedback is canceled.'''
+        if self.pool is None:
+            if self.tz_index is not None:
+                func = partial(func, tz_index=self.tz_index)
+            for context, args in shards:
+                if feedback.isCanceled():
+                    return
+                yield context, func(*args)
+            return
+        pending = deque()
+        for context, args in shards:
+            if feedback.isCanceled():
+                return
+            pending.append((context, self.pool.submit(func, *args)))
+            if len(pending) >= 2 * self.workers:
+                context, future = pending.popleft()
+                yield context, future.result()
+        while pending:
+            if feedback.isCanceled():
+                return
+            context, future = pending.popleft()
+            yield context, future.result()
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
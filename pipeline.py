@@ -0,0 +1,349 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from collections import OrderedDict
+from itertools import islice
+import numpy as np
+from qgis.core import (
+    NULL, QgsCsException, QgsExpression, QgsFeature, QgsFeatureRequest, QgsFeatureSink, QgsField, QgsFields,
+    QgsLineString, QgsPointXY, QgsProcessingException, QgsVectorDataProvider, QgsWkbTypes)
+from qgis.PyQt.QtCore import Qt, QDate, QDateTime, QTime, QVariant
+
+# Number of features that are read, resolved and written together
+CHUNK_SIZE = 10000
+# Number of feature x day values computed together in date range mode
+RANGE_CELLS = 200000
+
+OUTPUT_MODES = ['Point layer with all input attributes', 'Table with a key field and the new attributes (no geometry)']
+
+def iterChunks(iterator, size=CHUNK_SIZE):
+    '''Yield lists of up to size items from the iterator.'''
+    iterator = iter(iterator)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class OutputFeatureBuilder():
+    '''Builds the output fields and features of the enrichment algorithms.
+    The output either copies the input geometry and attributes or, when
+    attributes_only is set, only holds a key to join it back to the input
+    followed by the computed attributes. The key is key_field or the
+    source feature id if no key field is given.'''
+    def __init__(self, source, attributes_only=False, key_field=''):
+        self.attributes_only = attributes_only
+        in_fields = source.fields()
+        if attributes_only:
+            self.fields = QgsFields()
+            self.key_index = in_fields.indexOf(key_field) if key_field else -1
+            if self.key_index >= 0:
+                self.fields.append(in_fields.at(self.key_index))
+            else:
+                self.fields.append(QgsField('source_fid', QVariant.LongLong))
+            self.wkb_type = QgsWkbTypes.NoGeometry
+        else:
+            self.fields = QgsFields(in_fields)
+            self.wkb_type = source.wkbType()
+
+    def addField(self, name, field_type):
+        if self.fields.append(QgsField(name, field_type)) is False:
+            raise QgsProcessingException("Field names must be unique. There is already a field named '{}'".format(name))
+
+    def feature(self, feature, values):
+        f = QgsFeature()
+        if self.attributes_only:
+            key = feature.attribute(self.key_index) if self.key_index >= 0 else feature.id()
+            f.setAttributes([key] + list(values))
+        else:
+            f.setGeometry(feature.geometry())
+            f.setAttributes(feature.attributes() + list(values))
+        return f
+
+class CoordinateDeduplicator():
+    '''Deduplicates the coordinates of a layer so that the expensive per
+    point computations only run once per location. Coordinates are grouped
+    exactly or, if tolerance is greater than 0, snapped to a grid of
+    tolerance degrees. If same_zone is given, a point is only snapped when
+    same_zone(lons, lats, snapped_lons, snapped_lats) is True for it, so
+    that points are not moved into another time zone. Results are kept in
+    a least recently used cache of up to max_entries locations and fanned
+    back out to every feature.'''
+    def __init__(self, tolerance=0.0, max_entries=1000000, same_zone=None):
+        self.tolerance = tolerance
+        self.max_entries = max(1, max_entries)
+        self.same_zone = same_zone
+        self.memo = OrderedDict()
+        self.total = 0
+        self.computed = 0
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.max_error = None
+
+    def reduce(self, lons, lats):
+        '''Return the lon/lat arrays of the locations in this chunk that still
+        need to be computed and the state needed by expand.'''
+        valid = np.isfinite(lons) & np.isfinite(lats)
+        coords = np.column_stack((lons[valid], lats[valid]))
+        if self.tolerance > 0:
+            snapped = np.round(coords / self.tolerance) * self.tolerance
+            if self.same_zone is not None:
+                keep = self.same_zone(coords[:, 0], coords[:, 1], snapped[:, 0], snapped[:, 1])
+                snapped[~keep] = coords[~keep]
+            coords = snapped
+        unique, inverse = np.unique(coords, axis=0, return_inverse=True)
+        keys = [tuple(c) for c in unique.tolist()]
+        missing = []
+        # The cached values are taken now as they may be evicted before expand is called
+        cached = {}
+        for i, key in enumerate(keys):
+            try:
+                cached[i] = self.memo[key]
+                self.memo.move_to_end(key)
+            except KeyError:
+                missing.append(i)
+        self.total += len(lons)
+        self.computed += len(missing)
+        self.lookups += len(keys)
+        self.hits += len(cached)
+        todo = unique[missing]
+        return (todo[:, 0], todo[:, 1]), (valid, inverse.reshape(-1), keys, missing, cached)
+
+    def expand(self, state, results, default):
+        '''Return an object array with one result per point of the chunk.
+        results are the values computed for the locations returned by reduce
+        and points without a valid coordinate get default.'''
+        valid, inverse, keys, missing, cached = state
+        unique_values = np.empty(len(keys), dtype=object)
+        for i, value in cached.items():
+            unique_values[i] = value
+        for i, value in zip(missing, results):
+            unique_values[i] = value
+            self.memo[keys[i]] = value
+            if len(self.memo) > self.max_entries:
+                self.memo.popitem(last=False)
+                self.evictions += 1
+        values = np.empty(len(valid), dtype=object)
+        values.fill(default)
+        values[valid] = unique_values[inverse]
+        return values
+
+    def addErrors(self, errors):
+        '''Record the largest errors in seconds introduced by snapping the
+        computed locations.'''
+        errors = np.asarray(errors, dtype=np.float64)
+        errors = errors[np.isfinite(errors)]
+        self.max_error = max(self.max_error or 0.0, float(errors.max()) if len(errors) else 0.0)
+
+    def summary(self):
+        ratio = self.total / self.computed if self.computed else 0.0
+        rate = 100.0 * self.hits / self.lookups if self.lookups else 0.0
+        text = 'Deduplication: {} points, {} unique locations computed ({:.1f} points per location)'.format(
+            self.total, self.computed, ratio)
+        text += '\nLocation cache: {} lookups, {} hits ({:.1f}% hit rate), {} evictions'.format(
+            self.lookups, self.hits, rate, self.evictions)
+        if self.max_error is not None:
+            text += '\nLargest error introduced by the {} degree tolerance: {:.0f} seconds'.format(
+                self.tolerance, self.max_error)
+        return text
+
+class BufferedSink():
+    '''Collect output features and write them to the sink in batches of
+    batch_size with a single addFeatures call. Call flush() once all
+    features have been added.'''
+    def __init__(self, sink, batch_size=CHUNK_SIZE):
+        self.sink = sink
+        self.batch_size = max(1, batch_size)
+        self.buffer = []
+
+    def addFeature(self, feature):
+        self.buffer.append(feature)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            if not self.sink.addFeatures(self.buffer, QgsFeatureSink.FastInsert):
+                raise QgsProcessingException('Unable to write features to the output layer: {}'.format(self.sink.lastError()))
+            self.buffer = []
+
+class InPlaceUpdater():
+    '''Fills the empty values of the computed attributes of an existing
+    layer through its edit buffer. fields is a list of (name, QVariant type)
+    tuples. Fields that do not exist yet are added to the layer. If the
+    layer is already being edited the changes are left in its edit buffer,
+    otherwise editing is started and commit() saves them. Only the features
+    returned by request() need to be computed and only their empty values
+    are set. The layer must only be used from the main thread.'''
+    def __init__(self, layer, fields, batch_size=CHUNK_SIZE):
+        self.layer = layer
+        self.batch_size = max(1, batch_size)
+        self.changes = {}
+        caps = layer.dataProvider().capabilities()
+        if not caps & QgsVectorDataProvider.ChangeAttributeValues:
+            raise QgsProcessingException('The input layer does not support changing attribute values')
+        missing = [QgsField(name, field_type) for name, field_type in fields if layer.fields().indexOf(name) < 0]
+        if missing and not caps & QgsVectorDataProvider.AddAttributes:
+            raise QgsProcessingException('The input layer does not support adding new fields')
+        self.started = not layer.isEditable()
+        if self.started and not layer.startEditing():
+            raise QgsProcessingException('Unable to start editing the input layer')
+        for field in missing:
+            if not layer.addAttribute(field):
+                self.rollBack()
+                raise QgsProcessingException("Unable to add the field '{}' to the input layer".format(field.name()))
+        self.names = [name for name, field_type in fields]
+        self.indices = [layer.fields().indexOf(name) for name in self.names]
+        self.string_fields = [name for name, field_type in fields if field_type == QVariant.String]
+
+    def request(self):
+        '''Request for the features that have at least one empty value.'''
+        conditions = ['{} IS NULL'.format(QgsExpression.quotedColumnRef(name)) for name in self.names]
+        conditions += ["{} = ''".format(QgsExpression.quotedColumnRef(name)) for name in self.string_fields]
+        return QgsFeatureRequest().setFilterExpression(' OR '.join(conditions))
+
+    def updateFeature(self, feature, values):
+        attrs = {}
+        for index, value in zip(self.indices, values):
+            current = feature.attribute(index)
+            if current is None or current == NULL or current == '':
+                attrs[index] = value
+        if attrs:
+            self.changes[feature.id()] = attrs
+            if len(self.changes) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        for fid, attrs in self.changes.items():
+            if not self.layer.changeAttributeValues(fid, attrs):
+                raise QgsProcessingException('Unable to update the attributes of the input layer')
+        self.changes = {}
+
+    def commit(self):
+        '''Write the remaining changes and save the edits if editing was
+        started by the updater.'''
+        self.flush()
+        if self.started and not self.layer.commitChanges():
+            errors = '; '.join(self.layer.commitErrors())
+            self.rollBack()
+            raise QgsProcessingException('Unable to save the changes to the input layer: {}'.format(errors))
+
+    def rollBack(self):
+        '''Discard the changes if editing was started by the updater.'''
+        self.changes = {}
+        if self.started:
+            self.layer.rollBack()
+
+def coordinateShards(iterator, transform, dedup, *args, chunk_size=CHUNK_SIZE):
+    '''Yield the (context, args) shards used by ShardExecutor.imap. The
+    context is the chunk of up to chunk_size features and its deduplication
+    state. The arguments are the coordinates that still need to be computed
+    followed by args.'''
+    for chunk in iterChunks(iterator, chunk_size):
+        lons, lats = chunkCoordinates(chunk, transform)
+        todo, state = dedup.reduce(lons, lats)
+        yield (chunk, state), todo + args
+
+def timestampShards(iterator, transform, index, naive_utc=True):
+    '''Yield the (chunk, (lons, lats, epochs)) shards used by
+    ShardExecutor.imap for computations at the date/time attribute index
+    of each feature.'''
+    for chunk in iterChunks(iterator):
+        lons, lats = chunkCoordinates(chunk, transform)
+        yield chunk, (lons, lats, chunkEpochs(chunk, index, naive_utc))
+
+def chunkEpochs(features, index, naive_utc=True):
+    '''Return the UTC epoch seconds of the date/time attribute index of a
+    list of features. QDateTime, QDate and ISO 8601 string values are
+    accepted. Values without a time zone are UTC if naive_utc is set and
+    otherwise in the local time of the computer. Empty or invalid values
+    return NaN.'''
+    epochs = np.full(len(features), np.nan)
+    for i, feature in enumerate(features):
+        value = feature.attribute(index)
+        if isinstance(value, str):
+            value = QDateTime.fromString(value.strip(), Qt.ISODate)
+        elif isinstance(value, QDate):
+            value = QDateTime(value, QTime(0, 0))
+        if not isinstance(value, QDateTime) or not value.isValid():
+            continue
+        if naive_utc and value.timeSpec() == Qt.LocalTime:
+            value = QDateTime(value.date(), value.time(), Qt.UTC)
+        epochs[i] = value.toMSecsSinceEpoch() / 1000.0
+    return epochs
+
+def epochValues(epochs, offsets, field_type):
+    '''Convert an array of UTC epoch seconds to nested lists of attribute
+    values. For QVariant.DateTime the values are QDateTimes at the given
+    UTC offsets (UTC if offsets is None); otherwise they are whole epoch
+    seconds. NaN becomes NULL.'''
+    values = np.full(epochs.shape, None, dtype=object)
+    valid = np.isfinite(epochs)
+    if offsets is not None:
+        valid &= np.isfinite(offsets)
+    secs = epochs[valid].astype(np.int64).tolist()
+    if field_type != QVariant.DateTime:
+        values[valid] = secs
+    elif offsets is None:
+        values[valid] = [QDateTime.fromSecsSinceEpoch(sec, Qt.UTC) for sec in secs]
+    else:
+        offs = offsets[valid].astype(np.int64).tolist()
+        values[valid] = [QDateTime.fromSecsSinceEpoch(sec, Qt.OffsetFromUTC, off) for sec, off in zip(secs, offs)]
+    return values.tolist()
+
+def chunkCoordinates(features, transform=None):
+    '''Return the longitude and latitude arrays of a list of point features.
+    If transform is given the points are converted to EPSG:4326 in bulk.
+    Features without a usable point geometry return NaN.'''
+    xs = np.full(len(features), np.nan)
+    ys = np.full(len(features), np.nan)
+    for i, feature in enumerate(features):
+        geom = feature.geometry()
+        if geom.isEmpty():
+            continue
+        try:
+            pt = geom.asPoint()
+            xs[i] = pt.x()
+            ys[i] = pt.y()
+        except Exception:
+            pass
+    if transform:
+        xs, ys = transformCoordinates(xs, ys, transform)
+    return xs, ys
+
+def transformCoordinates(xs, ys, transform):
+    '''Transform coordinate arrays with a single call into the coordinate
+    transform by packing them into one line string. The transformed values
+    are read back from its WKB. If the bulk transform fails, each point is
+    transformed on its own and the points that fail become NaN.'''
+    out_x = np.full(len(xs), np.nan)
+    out_y = np.full(len(ys), np.nan)
+    valid = np.flatnonzero(np.isfinite(xs) & np.isfinite(ys))
+    if len(valid) == 0:
+        return out_x, out_y
+    line = QgsLineString(xs[valid].tolist(), ys[valid].tolist())
+    try:
+        line.transform(transform)
+        wkb = bytes(line.asWkb())
+        # WKB line string: byte order, geometry type, number of points, then x y pairs
+        dtype = '<f8' if wkb[0] == 1 else '>f8'
+        coords = np.frombuffer(wkb, dtype=dtype, offset=9).reshape(-1, 2)
+        out_x[valid] = coords[:, 0]
+        out_y[valid] = coords[:, 1]
+    except QgsCsException:
+        for i in valid:
+            try:
+                pt = transform.transform(QgsPointXY(xs[i], ys[i]))
+                out_x[i] = pt.x()
+                out_y[i] = pt.y()
+            except QgsCsException:
+                pass
+    return out_x, out_y
@@ -11,9 +11,13 @@
 import os
 from qgis.core import QgsProcessingProvider
 from qgis.PyQt.QtGui import QIcon
-from .addtimezone import AddTimezoneAlgorithm
-from .addastronomical import AddAstronomicalAlgorithm
-# from .convertdatetime import ConvertDateTimeAlgorithm
+from .addtimezone import AddTimezoneAlgorithm, FillTimezoneInPlaceAlgorithm
+from .addastronomical import AddAstronomicalAlgorithm, FillAstronomicalInPlaceAlgorithm
+from .addsunposition import AddSunPositionAlgorithm
+from .adddaylightclass import AddDaylightClassAlgorithm
+from .addmoon import AddMoonAttributesAlgorithm
+from .daylightraster import DaylightRasterAlgorithm
+from .convertdatetime import ConvertDateTimeAlgorithm
 
 class DateTimeToolsProvider(QgsProcessingProvider):
 
@@ -22,8 +26,18 @@ class DateTimeToolsProvider(QgsProcessingProvider):
 
     def loadAlgorithms(self):
         self.addAlgorithm(AddAstronomicalAlgorithm())
+        self.addAlgorithm(FillAstronomicalInPlaceAlgorithm())
+        self.addAlgorithm(AddSunPositionAlgorithm())
+        self.addAlgorithm(AddDaylightClassAlgorithm())
+        self.addAlgorithm(AddMoonAttributesAlgorithm())
+        self.addAlgorithm(DaylightRasterAlgorithm())
         self.addAlgorithm(AddTimezoneAlgorithm())
-        # self.addAlgorithm(ConvertDateTimeAlgorithm())
+        self.addAlgorithm(FillTimezoneInPlaceAlgorithm())
+        self.addAlgorithm(ConvertDateTimeAlgorithm())
+
+    def supportedOutputRasterLayerExtensions(self):
+        # The daylight raster is always written as GeoTIFF
+        return ['tif']
 
     def icon(self):
         return QIcon(os.path.dirname(__file__) + '/images/DateTime.svg')
@@ -9,16 +9,30 @@
  ***************************************************************************/
 """
 import os
-from qgis.core import QgsCoordinateReferenceSystem
+from qgis.core import QgsCoordinateReferenceSystem, QgsProcessingException
 from timezonefinder.timezonefinder import TimezoneFinder
+from .tzlookup import TimezoneGridIndex
 
 
 class InitTimeZoneFinder():
     tzf = None
+    tz_index = None
     def getTZF(self):
         if not self.tzf:
             self.tzf = TimezoneFinder()
         return( self.tzf )
+
+    def getTZIndex(self, feedback=None):
+        '''Return the grid index used for bulk time zone lookups. It is
+        cached on disk next to the plugin after it is first built. The
+        build reports its progress to feedback and can be canceled.'''
+        if not self.tz_index:
+            tz_index = TimezoneGridIndex(self.getTZF(), os.path.join(os.path.dirname(__file__), 'tzgrid.npz'),
+                feedback=feedback)
+            if tz_index.grid is None:
+                raise QgsProcessingException('Building the time zone grid index was canceled')
+            self.tz_index = tz_index
+        return( self.tz_index )
         
 tzf_instance = InitTimeZoneFinder()
 
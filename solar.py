@@ -0,0 +1,492 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import calendar
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+import numpy as np
+from astral.sun import dawn, dusk, sun
+from astral.location import LocationInfo
+
+from .tzlookup import zoneOffsets
+
+SUN_EVENTS = ['dawn', 'sunrise', 'noon', 'sunset', 'dusk']
+ENGINES = ['NumPy NOAA solar algorithm (vectorized)', 'Astral library (reference)']
+
+FMT_ISO_UTC = '%Y-%m-%dT%H:%M:%SZ'
+FMT_ISO_LOCAL = '%Y-%m-%dT%H:%M:%S%z'
+FMT_DEFAULT = '%Y-%m-%d %H:%M:%S %Z%z'
+
+# Zenith angles of the events before the refraction correction. These
+# match the astral defaults of civil dawn/dusk and a 32 arc minute sun.
+SUN_APPARENT_RADIUS = 32.0 / (60.0 * 2.0)
+ZENITH_CIVIL = 96.0
+ZENITH_SUNRISE = 90.0 + SUN_APPARENT_RADIUS
+
+# The sets of events that can be selected and the zenith angle and
+# direction (rising or not) of each event but noon. The golden hour (sun
+# between 4 degrees below and 6 degrees above the horizon) and the blue
+# hour (between 6 and 4 degrees below) follow the astral definitions.
+EVENT_SETS = [
+    ('Dawn, sunrise, noon, sunset and dusk (civil twilight)', SUN_EVENTS),
+    ('Nautical dawn and dusk', ['naut_dawn', 'naut_dusk']),
+    ('Astronomical dawn and dusk', ['astr_dawn', 'astr_dusk']),
+    ('Golden hour start and end, morning and evening', ['gold_am_s', 'gold_am_e', 'gold_pm_s', 'gold_pm_e']),
+    ('Blue hour start and end, morning and evening', ['blue_am_s', 'blue_am_e', 'blue_pm_s', 'blue_pm_e'])]
+EVENT_ZENITHS = {
+    'dawn': (ZENITH_CIVIL, True), 'sunrise': (ZENITH_SUNRISE, True),
+    'sunset': (ZENITH_SUNRISE, False), 'dusk': (ZENITH_CIVIL, False),
+    'naut_dawn': (102.0, True), 'naut_dusk': (102.0, False),
+    'astr_dawn': (108.0, True), 'astr_dusk': (108.0, False),
+    'gold_am_s': (94.0, True), 'gold_am_e': (84.0, True), 'gold_pm_s': (84.0, False), 'gold_pm_e': (94.0, False),
+    'blue_am_s': (96.0, True), 'blue_am_e': (94.0, True), 'blue_pm_s': (94.0, False), 'blue_pm_e': (96.0, False)}
+
+# Daylight classes and the lowest (refraction corrected) sun elevation of
+# each class but night. It is day while the upper limb of the sun is above
+# the horizon.
+DAYLIGHT_CLASSES = ['day', 'civil twilight', 'nautical twilight', 'astronomical twilight', 'night']
+DAYLIGHT_ELEVATIONS = np.array([-18.0, -12.0, -6.0, -SUN_APPARENT_RADIUS])
+
+# Longest span of days whose solar terms are tabulated every minute. Longer
+# daily series have few points per day, so the terms are computed directly.
+EPHEMERIS_DAYS = 366
+
+def astralEvents(observer, date, tz, events):
+    '''Return a dictionary with the datetime of each of the events computed
+    by astral, or None if the event does not occur. If one of SUN_EVENTS
+    does not occur all of them are None.'''
+    times = {}
+    if any(event in SUN_EVENTS for event in events):
+        try:
+            times = dict(sun(observer, date=date, tzinfo=tz))
+        except Exception:
+            pass
+    for event in events:
+        if event in SUN_EVENTS:
+            times.setdefault(event, None)
+            continue
+        zenith, rising = EVENT_ZENITHS[event]
+        try:
+            times[event] = (dawn if rising else dusk)(observer, date, depression=zenith - 90.0, tzinfo=tz)
+        except Exception:
+            times[event] = None
+    return times
+
+def sunTimesAstral(lons, lats, date, tz_names, fmt, events=SUN_EVENTS):
+    '''Return a list with the formatted times of the events (by default
+    dawn, sunrise, noon, sunset and dusk) of each coordinate. If tz_names is
+    None the times are in UTC; otherwise they are in the time zone of each
+    point. Events that do not occur get empty strings.'''
+    results = []
+    for i in range(len(lons)):
+        try:
+            locl = LocationInfo('','','',lats[i], lons[i])
+            tz = timezone.utc if tz_names is None else ZoneInfo(tz_names[i])
+            times = astralEvents(locl.observer, date, tz, events)
+            results.append([times[event].strftime(fmt) if times[event] else '' for event in events])
+        except Exception:
+            results.append([''] * len(events))
+    return results
+
+def sunEpochsAstral(lons, lats, date, days, tz_names, events=SUN_EVENTS):
+    '''astral version of sunEpochsNumpy, one point and day at a time'''
+    epochs = np.full((len(lons), days, len(events)), np.nan)
+    offsets = np.full(epochs.shape, np.nan)
+    for d in range(days):
+        day = date + timedelta(days=d)
+        for i in range(len(lons)):
+            try:
+                locl = LocationInfo('','','',lats[i], lons[i])
+                tz = timezone.utc if tz_names is None else ZoneInfo(tz_names[i])
+                times = astralEvents(locl.observer, day, tz, events)
+            except Exception:
+                continue
+            for j, event in enumerate(events):
+                if times[event]:
+                    epochs[i, d, j] = np.floor(times[event].timestamp())
+                    offsets[i, d, j] = times[event].utcoffset().total_seconds()
+    return epochs, offsets
+
+# The NumPy engine below follows the NOAA solar calculations in the same
+# way as astral so that both engines give the same times.
+
+def julianDay(date):
+    '''Julian day at 00:00 UTC of date'''
+    year = date.year
+    month = date.month
+    if month <= 2:
+        year -= 1
+        month += 12
+    a = int(year / 100)
+    b = 2 - a + int(a / 4)
+    return int(365.25 * (year + 4716)) + int(30.6001 * (month + 1)) + date.day + b - 1524.5
+
+def julianCentury(jd):
+    return (jd - 2451545.0) / 36525.0
+
+def sunDeclination(jc):
+    '''Declination of the sun in degrees'''
+    m = np.radians(357.52911 + jc * (35999.05029 - 0.0001537 * jc))
+    c = (np.sin(m) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+        + np.sin(2 * m) * (0.019993 - 0.000101 * jc) + np.sin(3 * m) * 0.000289)
+    l0 = (280.46646 + jc * (36000.76983 + 0.0003032 * jc)) % 360.0
+    omega = np.radians(125.04 - 1934.136 * jc)
+    apparent_long = l0 + c - 0.00569 - 0.00478 * np.sin(omega)
+    return np.degrees(np.arcsin(np.sin(np.radians(obliquityCorrection(jc))) * np.sin(np.radians(apparent_long))))
+
+def obliquityCorrection(jc):
+    seconds = 21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))
+    e0 = 23.0 + (26.0 + (seconds / 60.0)) / 60.0
+    return e0 + 0.00256 * np.cos(np.radians(125.04 - 1934.136 * jc))
+
+def eqOfTime(jc):
+    '''Equation of time in minutes'''
+    l0 = np.radians((280.46646 + jc * (36000.76983 + 0.0003032 * jc)) % 360.0)
+    e = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    m = np.radians(357.52911 + jc * (35999.05029 - 0.0001537 * jc))
+    y = np.tan(np.radians(obliquityCorrection(jc)) / 2.0) ** 2
+    etime = (y * np.sin(2.0 * l0) - 2.0 * e * np.sin(m) + 4.0 * e * y * np.sin(m) * np.cos(2.0 * l0)
+        - 0.5 * y * y * np.sin(4.0 * l0) - 1.25 * e * e * np.sin(2.0 * m))
+    return np.degrees(etime) * 4.0
+
+def refractionAtZenith(zenith):
+    '''Refraction correction in degrees for a zenith angle'''
+    elevation = 90.0 - np.asarray(zenith, dtype=np.float64)
+    te = np.tan(np.radians(elevation))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correction = np.where(
+            elevation > 5.0, 58.1 / te - 0.07 / te ** 3 + 0.000086 / te ** 5,
+            np.where(elevation > -0.575,
+                1735.0 + elevation * (-518.2 + elevation * (103.4 + elevation * (-12.79 + elevation * 0.711))),
+                -20.774 / te))
+    return np.where(elevation >= 85.0, 0.0, correction / 3600.0)
+
+def sunPosition(lons, lats, epochs, with_azimuth=True):
+    '''Return the azimuth (degrees clockwise from north) and the elevation
+    (degrees above the horizon, corrected for refraction) of the sun at
+    each coordinate and UTC epoch seconds, computed the same way as the
+    astral azimuth and elevation functions. NaN epochs give NaN. If
+    with_azimuth is False only the elevation is computed and the azimuth
+    is None.'''
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -89.8, 89.8)
+    # Like astral only whole seconds are used
+    secs = np.floor(np.asarray(epochs, dtype=np.float64))
+    jc = julianCentury(2440587.5 + secs / 86400.0)
+    declination = np.radians(sunDeclination(jc))
+    true_solar_time = np.mod(secs, 86400.0) / 60.0 + eqOfTime(jc) + 4.0 * lons
+    hour_angle = np.mod(true_solar_time / 4.0, 360.0) - 180.0
+    cl = np.cos(np.radians(lats))
+    sl = np.sin(np.radians(lats))
+    sd = np.sin(declination)
+    cd = np.cos(declination)
+    csz = np.clip(cl * cd * np.cos(np.radians(hour_angle)) + sl * sd, -1.0, 1.0)
+    zenith = np.degrees(np.arccos(csz))
+    invalid = ~np.isfinite(secs) | ~np.isfinite(lons)
+    elevation = 90.0 - (zenith - refractionAtZenith(zenith))
+    elevation[invalid] = np.nan
+    if not with_azimuth:
+        return None, elevation
+    az_denom = cl * np.sin(np.radians(zenith))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        az_rad = np.clip((sl * np.cos(np.radians(zenith)) - sd) / az_denom, -1.0, 1.0)
+    azimuth = 180.0 - np.degrees(np.arccos(az_rad))
+    azimuth = np.where(hour_angle > 0.0, -azimuth, azimuth)
+    # Directly above or below the pole of the observer
+    azimuth = np.where(np.abs(az_denom) > 0.001, azimuth, np.where(lats > 0.0, 180.0, 0.0))
+    azimuth = np.where(azimuth < 0.0, azimuth + 360.0, azimuth)
+    azimuth[invalid] = np.nan
+    return azimuth, elevation
+
+def daylightClasses(lons, lats, epochs):
+    '''Return the index into DAYLIGHT_CLASSES of each coordinate and UTC
+    epoch seconds from the elevation of the sun alone, without computing
+    any event times. Invalid points give -1.'''
+    elevation = sunPosition(lons, lats, epochs, with_azimuth=False)[1]
+    classes = np.searchsorted(DAYLIGHT_ELEVATIONS, elevation, side='right')
+    # Count from day (0) to night
+    classes = (len(DAYLIGHT_ELEVATIONS) - classes).astype(np.int8)
+    classes[np.isnan(elevation)] = -1
+    return classes
+
+class SolarEphemeris():
+    '''The date dependent terms of the solar calculations, the declination
+    of the sun and the equation of time, are the same for every point. They
+    are computed once for the days starting at jd, tabulated every minute
+    from the day before to three days after the last day, and interpolated
+    for each point so only the latitude and longitude dependent terms are
+    computed per point. Without tabulate they are computed for each point,
+    which keeps the memory of long daily series bounded.'''
+    STEP = 1.0 / 1440.0
+
+    def __init__(self, jd, days=1, tabulate=True):
+        self.jd = jd
+        self.days = days
+        self.times = None
+        if tabulate:
+            self.times = jd - 1.0 + np.arange((days + 3) * 1440 + 1) * self.STEP
+            jc = julianCentury(self.times)
+            self.declinations = sunDeclination(jc)
+            self.eqtimes = eqOfTime(jc)
+        self.noon_eqtimes = eqOfTime(julianCentury(jd + np.arange(days)))
+
+    def declination(self, jd):
+        if self.times is None:
+            return sunDeclination(julianCentury(jd))
+        return np.interp(jd, self.times, self.declinations)
+
+    def eqOfTime(self, jd):
+        if self.times is None:
+            return eqOfTime(julianCentury(jd))
+        return np.interp(jd, self.times, self.eqtimes)
+
+@lru_cache(maxsize=4)
+def solarEphemeris(jd, days=1):
+    '''Ephemeris of the days starting at jd, shared by all chunks and runs.
+    Only spans of up to EPHEMERIS_DAYS days are tabulated.'''
+    return SolarEphemeris(jd, days, days <= EPHEMERIS_DAYS)
+
+def timeOfTransit(lons, lats, jd, zenith, rising, ephemeris):
+    '''Minutes after 00:00 UTC of the days jd when the sun crosses zenith
+    (before refraction) while rising or setting. The arguments broadcast
+    against each other so several events can be computed in one pass. NaN
+    where the sun never reaches that zenith.'''
+    lats = np.clip(lats, -89.8, 89.8)
+    lat_rad = np.radians(lats)
+    sin_lat = np.sin(lat_rad)
+    cos_lat = np.cos(lat_rad)
+    cos_zenith = np.cos(np.radians(zenith + refractionAtZenith(zenith)))
+    adjustment = 0.0
+    time_utc = 0.0
+    for _ in range(2):
+        dec_rad = np.radians(ephemeris.declination(jd + adjustment))
+        h = (cos_zenith - sin_lat * np.sin(dec_rad)) / (cos_lat * np.cos(dec_rad))
+        with np.errstate(invalid='ignore'):
+            hour_angle = np.degrees(np.arccos(np.where(np.abs(h) <= 1.0, h, np.nan)))
+        hour_angle = np.where(rising, hour_angle, -hour_angle)
+        offset = (-lons - hour_angle) * 4.0 - ephemeris.eqOfTime(jd + adjustment)
+        offset = np.where(offset < -720.0, offset + 1440.0, offset)
+        time_utc = 720.0 + offset
+        adjustment = time_utc / 1440.0
+    return time_utc
+
+def zoneGroups(tz_names):
+    '''Group points by time zone for localOffsets. Returns the distinct
+    zone names and the index of the zone of each point, or None for UTC.'''
+    if tz_names is None:
+        return None
+    zones, inverse = np.unique(np.asarray(tz_names, dtype=str), return_inverse=True)
+    return zones, inverse.reshape(-1)
+
+def localOffsets(epochs, groups):
+    '''UTC offsets in seconds at each epoch in the time zone of each point
+    where groups is returned by zoneGroups. Without time zones the offsets
+    are 0 (UTC).'''
+    if groups is None:
+        return np.zeros(len(epochs))
+    zones, inverse = groups
+    offsets = np.full(len(epochs), np.nan)
+    for i, tz_name in enumerate(zones):
+        mask = inverse == i
+        if mask.any():
+            offsets[mask] = zoneOffsets(tz_name, epochs[mask])
+    return offsets
+
+def sunEventsRange(lons, lats, date, days, tz_names=None, events=SUN_EVENTS):
+    '''Compute the times of the events (by default dawn, sunrise, noon,
+    sunset and dusk) of whole coordinate arrays for each of the days
+    starting at date. All events, points and days are computed together by
+    broadcasting them to an events x points x days grid so the terms that
+    do not depend on the event are shared. Returns two dictionaries keyed
+    by event name with (points, days) arrays of the UTC epoch seconds and
+    the UTC offset in seconds of each time. Like astral, rising and setting
+    events are searched on the date in the time zone of each point (UTC if
+    tz_names is None). Events that do not occur, e.g. in polar day and
+    night, are NaN. If one of SUN_EVENTS does not occur on a day all of
+    them are NaN on that day.'''
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    shape = (len(lons), days)
+    ephemeris = solarEphemeris(julianDay(date), days)
+    start = calendar.timegm((date.year, date.month, date.day, 0, 0, 0))
+    # Flattened grid where the days of a point are contiguous
+    lons = np.broadcast_to(lons[:, np.newaxis], shape).ravel()
+    lats = np.broadcast_to(lats[:, np.newaxis], shape).ravel()
+    jd = np.broadcast_to(ephemeris.jd + np.arange(days, dtype=np.float64), shape).ravel()
+    base = np.broadcast_to(start + 86400.0 * np.arange(days), shape).ravel()
+    day = base // 86400
+    groups = zoneGroups(tz_names)
+    if groups is not None:
+        groups = (groups[0], np.broadcast_to(groups[1][:, np.newaxis], shape).ravel())
+    epochs = {}
+    offsets = {}
+    transits = [event for event in events if event in EVENT_ZENITHS]
+    if transits:
+        # One row per event; each row covers the whole points x days grid
+        count = len(transits)
+        zenith = np.array([EVENT_ZENITHS[event][0] for event in transits])[:, np.newaxis]
+        rising = np.array([EVENT_ZENITHS[event][1] for event in transits])[:, np.newaxis]
+        epoch = (base + timeOfTransit(lons, lats, jd, zenith, rising, ephemeris) * 60.0).ravel()
+
+        def grid(values):
+            '''Flattened events x grid version of values'''
+            return np.broadcast_to(values, (count, len(lons))).ravel()
+
+        all_groups = None if groups is None else (groups[0], grid(groups[1]))
+        offset = localOffsets(epoch, all_groups)
+        # If the event falls on another local date search the next or previous day
+        local_day = np.floor((epoch + offset) / 86400.0)
+        for delta in (1, -1):
+            redo = np.flatnonzero((local_day - grid(day)) * delta < 0)
+            if len(redo):
+                epoch[redo] = grid(base)[redo] + delta * 86400 + timeOfTransit(
+                    grid(lons)[redo], grid(lats)[redo], grid(jd)[redo] + delta,
+                    grid(zenith)[redo], grid(rising)[redo], ephemeris) * 60.0
+                offset[redo] = localOffsets(epoch[redo], None if groups is None else (groups[0], all_groups[1][redo]))
+        local_day = np.floor((epoch + offset) / 86400.0)
+        epoch[local_day != grid(day)] = np.nan
+        epoch = epoch.reshape(count, len(lons))
+        offset = offset.reshape(count, len(lons))
+        for i, event in enumerate(transits):
+            epochs[event] = epoch[i]
+            offsets[event] = offset[i]
+    if 'noon' in events:
+        # Solar noon; astral truncates it to whole seconds towards zero
+        noon = 720.0 - 4.0 * lons - np.broadcast_to(ephemeris.noon_eqtimes, shape).ravel()
+        epochs['noon'] = base + np.trunc(noon * 60.0)
+        offsets['noon'] = localOffsets(epochs['noon'], groups)
+    standard = [event for event in events if event in SUN_EVENTS]
+    missing = np.zeros(len(lons), dtype=bool)
+    for event in standard:
+        missing |= ~np.isfinite(epochs[event]) | ~np.isfinite(offsets[event])
+    for event in events:
+        if event in standard:
+            epochs[event][missing] = np.nan
+        epochs[event] = epochs[event].reshape(shape)
+        offsets[event] = offsets[event].reshape(shape)
+    return epochs, offsets
+
+def snapError(lons, lats, date, days, tolerance, events=SUN_EVENTS):
+    '''Largest change in seconds of any of the events over the days starting
+    at date when each location is moved to the corners of its tolerance
+    degree cell. This bounds the error of using the value at the cell
+    center for all points in the cell. Events that fall on another day at a
+    corner are compared modulo a day.'''
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    errors = np.zeros(len(lons))
+    if not len(lons):
+        return errors
+    center = sunEventsRange(lons, lats, date, days, None, events)[0]
+    half = tolerance / 2.0
+    for dx, dy in ((-half, -half), (-half, half), (half, -half), (half, half)):
+        corner = sunEventsRange(lons + dx, np.clip(lats + dy, -90.0, 90.0), date, days, None, events)[0]
+        for event in events:
+            diff = np.abs(np.mod(corner[event] - center[event] + 43200.0, 86400.0) - 43200.0)
+            errors = np.fmax(errors, np.nanmax(diff, axis=1, initial=0.0))
+    return errors
+
+def dayLength(lons, lats, date):
+    '''Hours between sunrise and sunset on date from the sunrise hour angle
+    with the declination of the sun at solar noon. 24 during polar day and
+    0 during polar night.'''
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -89.8, 89.8)
+    jd = julianDay(date)
+    ephemeris = solarEphemeris(jd)
+    noon = jd + (720.0 - 4.0 * lons - ephemeris.noon_eqtimes[0]) / 1440.0
+    dec_rad = np.radians(ephemeris.declination(noon))
+    lat_rad = np.radians(lats)
+    cos_zenith = np.cos(np.radians(ZENITH_SUNRISE + refractionAtZenith(ZENITH_SUNRISE)))
+    h = (cos_zenith - np.sin(lat_rad) * np.sin(dec_rad)) / (np.cos(lat_rad) * np.cos(dec_rad))
+    return 2.0 * np.degrees(np.arccos(np.clip(h, -1.0, 1.0))) / 15.0
+
+def eventHours(lons, lats, date, event, tz_names=None):
+    '''Hours after midnight of date, in UTC or in the time zone of each
+    point, of event. NaN where it does not occur on that date.'''
+    epochs, offsets = sunEvents(lons, lats, date, tz_names, [event])
+    midnight = calendar.timegm((date.year, date.month, date.day, 0, 0, 0))
+    return (epochs[event] + offsets[event] - midnight) / 3600.0
+
+def sunEvents(lons, lats, date, tz_names=None, events=SUN_EVENTS):
+    '''Single day version of sunEventsRange returning 1-D arrays'''
+    epochs, offsets = sunEventsRange(lons, lats, date, 1, tz_names, events)
+    return ({event: values[:, 0] for event, values in epochs.items()},
+        {event: values[:, 0] for event, values in offsets.items()})
+
+def formatEpochs(epochs, offsets, tz_names, fmt):
+    '''Format UTC epoch seconds in the time zone with the given offsets.
+    The formats used by the sun attributes algorithm are built with NumPy
+    string operations; others fall back to strftime. NaN becomes an empty
+    string.'''
+    valid = np.isfinite(epochs)
+    result = np.full(len(epochs), '', dtype=object)
+    if not valid.any():
+        return result
+    secs = np.floor(epochs[valid]).astype(np.int64)
+    offs = offsets[valid].astype(np.int64)
+    names = None if tz_names is None else np.asarray(tz_names, dtype=str)[valid]
+    if fmt not in (FMT_ISO_UTC, FMT_ISO_LOCAL, FMT_DEFAULT):
+        for i, sec in zip(np.flatnonzero(valid).tolist(), secs.tolist()):
+            tz = timezone.utc if tz_names is None else ZoneInfo(tz_names[i])
+            result[i] = datetime.fromtimestamp(sec, tz).strftime(fmt)
+        return result
+    stamps = np.datetime_as_string((secs + offs).astype('datetime64[s]'))
+    if fmt == FMT_ISO_UTC:
+        result[valid] = np.char.add(stamps, 'Z')
+        return result
+    unique_offs, inverse = np.unique(offs, return_inverse=True)
+    zstrings = np.array(['{}{:02d}{:02d}'.format('-' if o < 0 else '+', abs(o) // 3600, abs(o) % 3600 // 60)
+        for o in unique_offs.tolist()])[inverse.reshape(-1)]
+    if fmt == FMT_ISO_LOCAL:
+        result[valid] = np.char.add(stamps, zstrings)
+        return result
+    # FMT_DEFAULT also needs the time zone abbreviation (%Z)
+    if names is None:
+        abbrevs = np.full(len(secs), 'UTC')
+    else:
+        pairs, first, inverse = np.unique(np.char.add(names, np.char.add('|', offs.astype(str))),
+            return_index=True, return_inverse=True)
+        labels = [datetime.fromtimestamp(sec, ZoneInfo(name)).strftime('%Z')
+            for sec, name in zip(secs[first].tolist(), names[first].tolist())]
+        abbrevs = np.array(labels)[inverse.reshape(-1)]
+    stamps = np.char.replace(stamps, 'T', ' ')
+    result[valid] = np.char.add(np.char.add(stamps, ' '), np.char.add(abbrevs, zstrings))
+    return result
+
+def sunTimesNumpy(lons, lats, date, tz_names, fmt, events=SUN_EVENTS):
+    '''NumPy version of sunTimesAstral'''
+    epochs, offsets = sunEvents(lons, lats, date, tz_names, events)
+    columns = [formatEpochs(epochs[event], offsets[event], tz_names, fmt) for event in events]
+    return np.column_stack(columns).tolist() if len(lons) else []
+
+def sunTimesNumpyRange(lons, lats, date, days, tz_names, fmt, events=SUN_EVENTS):
+    '''Return for each coordinate a list with one list of formatted event
+    times per day starting at date.'''
+    if not len(lons):
+        return []
+    epochs, offsets = sunEventsRange(lons, lats, date, days, tz_names, events)
+    names = None if tz_names is None else np.repeat(np.asarray(tz_names, dtype=object), days)
+    columns = [formatEpochs(epochs[event].ravel(), offsets[event].ravel(), names, fmt) for event in events]
+    return np.column_stack(columns).reshape(len(lons), days, len(events)).tolist()
+
+def sunEpochsNumpy(lons, lats, date, days, tz_names, events=SUN_EVENTS):
+    '''Return (points, days, events) arrays of the whole UTC epoch seconds
+    and UTC offsets of the events without formatting them. Missing events
+    are NaN.'''
+    epochs, offsets = sunEventsRange(lons, lats, date, days, tz_names, events)
+    return (np.floor(np.stack([epochs[event] for event in events], axis=-1)),
+        np.stack([offsets[event] for event in events], axis=-1))
+
+def sunTimesAstralRange(lons, lats, date, days, tz_names, fmt, events=SUN_EVENTS):
+    '''astral version of sunTimesNumpyRange, one day at a time'''
+    per_day = [sunTimesAstral(lons, lats, date + timedelta(days=d), tz_names, fmt, events) for d in range(days)]
+    return [list(rows) for rows in zip(*per_day)]
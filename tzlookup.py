@@ -0,0 +1,294 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+import numpy as np
+
+@lru_cache(maxsize=None)
+def getZone(tz_name):
+    return ZoneInfo(tz_name)
+
+# UTC epoch seconds of 0001-01-01 and 10000-01-01, the range of datetime
+MIN_EPOCH = -62135596800
+MAX_EPOCH = 253402300800
+
+@lru_cache(maxsize=4096)
+def zoneTransitions(tz_name, first_day, last_day):
+    '''Return the UTC epoch seconds of the offset changes of time zone
+    tz_name from the start of UTC day first_day to the end of last_day and
+    the offsets in effect before, between and after them. The zone is
+    sampled once a day and each change is located to the second by
+    bisection, so at most one change per day is expected.'''
+    tz = getZone(tz_name)
+    samples = [day * 86400 for day in range(first_day, last_day + 1)] + [(last_day + 1) * 86400 - 1]
+    offsets = [datetime.fromtimestamp(t, tz).utcoffset().total_seconds() for t in samples]
+    transitions = []
+    values = [offsets[0]]
+    for i in range(1, len(samples)):
+        if offsets[i] == values[-1]:
+            continue
+        lo = samples[i - 1]
+        hi = samples[i]
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if datetime.fromtimestamp(mid, tz).utcoffset().total_seconds() == values[-1]:
+                lo = mid
+            else:
+                hi = mid
+        transitions.append(hi)
+        values.append(offsets[i])
+    return np.array(transitions, dtype=np.float64), np.array(values)
+
+def zoneOffsets(tz_name, epochs):
+    '''Return the UTC offsets in seconds of time zone tz_name at the UTC
+    epoch seconds in the epochs array. The offset changes of each distinct
+    year of the epochs are found once (and cached) and the offsets of the
+    epochs of that year are looked up in them. Unknown time zones, NaN
+    epochs and epochs whose local time is out of range give NaN.'''
+    offsets = np.full(len(epochs), np.nan)
+    valid = np.isfinite(epochs)
+    valid[valid] = (epochs[valid] >= MIN_EPOCH) & (epochs[valid] < MAX_EPOCH)
+    if not tz_name or not valid.any():
+        return offsets
+    index = np.flatnonzero(valid)
+    values = epochs[index]
+    years = np.floor(values / 86400).astype(np.int64).astype('datetime64[D]').astype('datetime64[Y]')
+    for year in np.unique(years):
+        first_day = int(year.astype('datetime64[D]').astype(np.int64))
+        last_day = int((year + 1).astype('datetime64[D]').astype(np.int64)) - 1
+        try:
+            transitions, zone_offsets = zoneTransitions(tz_name, first_day, last_day)
+        except Exception:
+            # Only the epochs of a year that cannot be converted are left out
+            continue
+        mask = years == year
+        offsets[index[mask]] = zone_offsets[np.searchsorted(transitions, values[mask], side='right')]
+    return offsets
+
+class BatchTimezoneLookup():
+    '''Resolve the time zones of whole arrays of longitude/latitude
+    coordinates. Identical coordinates within a batch are only looked
+    up once and coordinates that cannot be resolved return an empty string.'''
+    def __init__(self, tzf):
+        self.tzf = tzf
+
+    def timezonesAt(self, lons, lats):
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        names = np.full(lons.shape, '', dtype=object)
+        valid = np.isfinite(lons) & np.isfinite(lats) & (np.abs(lons) <= 180.0) & (np.abs(lats) <= 90.0)
+        if not valid.any():
+            return names
+        coords = np.column_stack((lons[valid], lats[valid]))
+        unique, inverse = np.unique(coords, axis=0, return_inverse=True)
+        resolved = np.empty(len(unique), dtype=object)
+        timezone_at = self.tzf.timezone_at
+        for i, (lon, lat) in enumerate(unique.tolist()):
+            try:
+                resolved[i] = timezone_at(lng=lon, lat=lat) or ''
+            except Exception:
+                resolved[i] = ''
+        names[valid] = resolved[inverse.reshape(-1)]
+        return names
+
+class TimezoneGridIndex():
+    '''A global grid of resolution degree cells where each cell is either
+    labeled with the single time zone covering it or marked as a boundary
+    cell. Points in interior cells are answered directly from the grid and
+    only points in boundary cells fall back to the polygon test of
+    TimezoneFinder. The grid is built once and cached in cache_file. If the
+    build is canceled through feedback, grid is None.'''
+    BOUNDARY = -1
+
+    def __init__(self, tzf, cache_file=None, resolution=0.25, grid=None, names=None, feedback=None):
+        self.tzf = tzf
+        self.cache_file = cache_file
+        self.resolution = resolution
+        self.lookup = BatchTimezoneLookup(tzf)
+        self.nrows = int(round(180.0 / resolution))
+        self.ncols = int(round(360.0 / resolution))
+        self.version = self.dataVersion()
+        if grid is not None:
+            # An index that has already been built, e.g. by the parent of a worker process
+            self.grid = grid
+            self.names = np.asarray(names, dtype=object)
+        elif not self.load():
+            self.grid = None
+            if self.build(feedback):
+                self.save()
+
+    def dataVersion(self):
+        try:
+            from importlib.metadata import version
+            pkg_version = version('timezonefinder')
+        except Exception:
+            pkg_version = ''
+        return '{}:{}'.format(pkg_version, getattr(self.tzf, 'data_version', ''))
+
+    def load(self):
+        if not self.cache_file:
+            return False
+        try:
+            with np.load(self.cache_file, allow_pickle=False) as data:
+                if str(data['version']) != self.version or float(data['resolution']) != self.resolution:
+                    return False
+                self.grid = data['grid']
+                self.names = data['names'].astype(object)
+            return True
+        except Exception:
+            return False
+
+    def save(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, 'wb') as fp:
+                np.savez_compressed(fp, version=self.version, resolution=self.resolution,
+                    grid=self.grid, names=self.names.astype(str))
+        except Exception:
+            # The plugin directory may not be writable. The grid is rebuilt next session.
+            pass
+
+    def build(self, feedback=None):
+        '''Build the grid, reporting progress to the optional processing
+        feedback. Returns False if it is canceled.'''
+        if feedback is not None:
+            feedback.pushInfo('Building the time zone grid index. This is only done once and can take a few minutes.')
+        # Each cell is sampled on a 3 x 3 lattice shared with its neighbors.
+        step = self.resolution / 2.0
+        unique_at = getattr(self.tzf, 'unique_timezone_at', self.tzf.timezone_at)
+        codes = {}
+        samples = np.empty((2 * self.nrows + 1, 2 * self.ncols + 1), dtype=np.int32)
+        for r in range(samples.shape[0]):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    return False
+                feedback.setProgress(100.0 * r / samples.shape[0])
+            lat = min(-90.0 + r * step, 90.0)
+            for c in range(samples.shape[1]):
+                lon = min(-180.0 + c * step, 180.0)
+                try:
+                    name = unique_at(lng=lon, lat=lat)
+                except Exception:
+                    name = None
+                samples[r, c] = codes.setdefault(name, len(codes)) if name else self.BOUNDARY
+        grid = samples[0:-1:2, 0:-1:2].copy()
+        for dr in range(3):
+            for dc in range(3):
+                view = samples[dr:dr + 2 * self.nrows:2, dc:dc + 2 * self.ncols:2]
+                grid[view != grid] = self.BOUNDARY
+        # Only trust cells whose neighbors share the same zone so that points
+        # are never answered from the grid close to a time zone boundary.
+        padded = np.pad(grid, ((1, 1), (0, 0)), mode='edge')
+        interior = grid != self.BOUNDARY
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                neighbor = np.roll(padded[1 + dr:1 + dr + self.nrows], dc, axis=1)
+                interior &= neighbor == grid
+        self.grid = np.where(interior, grid, self.BOUNDARY).astype(np.int16)
+        self.names = np.empty(len(codes), dtype=object)
+        for name, code in codes.items():
+            self.names[code] = name
+        return True
+
+    def timezonesAt(self, lons, lats):
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        names = np.full(lons.shape, '', dtype=object)
+        valid = np.isfinite(lons) & np.isfinite(lats) & (np.abs(lons) <= 180.0) & (np.abs(lats) <= 90.0)
+        rows = np.clip(((lats[valid] + 90.0) / self.resolution).astype(np.int64), 0, self.nrows - 1)
+        cols = np.clip(((lons[valid] + 180.0) / self.resolution).astype(np.int64), 0, self.ncols - 1)
+        cells = self.grid[rows, cols]
+        resolved = np.full(cells.shape, '', dtype=object)
+        interior = cells != self.BOUNDARY
+        resolved[interior] = self.names[cells[interior]]
+        boundary = ~interior
+        if boundary.any():
+            resolved[boundary] = self.lookup.timezonesAt(lons[valid][boundary], lats[valid][boundary])
+        names[valid] = resolved
+        return names
+
+    def cellCodes(self, lons, lats):
+        '''Zone code of the grid cell of each point. BOUNDARY for boundary
+        cells and invalid points.'''
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        codes = np.full(lons.shape, self.BOUNDARY, dtype=np.int16)
+        valid = np.isfinite(lons) & np.isfinite(lats) & (np.abs(lons) <= 180.0) & (np.abs(lats) <= 90.0)
+        rows = np.clip(((lats[valid] + 90.0) / self.resolution).astype(np.int64), 0, self.nrows - 1)
+        cols = np.clip(((lons[valid] + 180.0) / self.resolution).astype(np.int64), 0, self.ncols - 1)
+        codes[valid] = self.grid[rows, cols]
+        return codes
+
+    def sameZone(self, lons1, lats1, lons2, lats2):
+        '''True where both points are in interior cells of the same time
+        zone. As the neighbors of an interior cell are in the same zone this
+        is exact for points up to resolution degrees apart.'''
+        codes = self.cellCodes(lons1, lats1)
+        return (codes != self.BOUNDARY) & (codes == self.cellCodes(lons2, lats2))
+
+    def timezone_at(self, lng, lat):
+        '''Single point version with the same signature as TimezoneFinder'''
+        return self.timezonesAt([lng], [lat])[0] or None
+
+class OffsetCache():
+    '''Cache of the UTC offset strings (+HHMM) of time zones keyed on the
+    time zone name and date. The number of hits and misses are kept so
+    they can be reported at the end of a run.'''
+    def __init__(self):
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def offset(self, tz_name, date):
+        key = (tz_name, date)
+        try:
+            value = self.cache[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        self.misses += 1
+        value = ''
+        if tz_name:
+            try:
+                value = date.replace(tzinfo=ZoneInfo(tz_name)).strftime('%z')
+            except Exception:
+                pass
+        self.cache[key] = value
+        return value
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return 'Offset cache: {} hits, {} misses ({:.1f}% hit rate), {} offsets computed'.format(
+            self.hits, self.misses, rate, len(self.cache))
+
+class ZoneCodes():
+    '''Integer codes for time zone names. The code of a zone is its position
+    in the TimezoneFinder list of zone names so the codes are the same in
+    every run made with the same time zone data. The codes that have been
+    handed out are kept for writing the lookup table.'''
+    def __init__(self, zone_names):
+        self.zone_names = list(zone_names)
+        self.codes = {name: code for code, name in enumerate(self.zone_names)}
+        self.used = set()
+
+    def code(self, tz_name):
+        code = self.codes.get(tz_name)
+        if code is not None:
+            self.used.add(code)
+        return code
+
+    def usedZones(self):
+        '''Return a list of (code, name) tuples of the codes handed out.'''
+        return [(code, self.zone_names[code]) for code in sorted(self.used)]